@@ -0,0 +1,97 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .fastpath import JSONBytesResponse
+from .replicas import primary_reads
+
+
+def get_cache():
+    return caches[getattr(settings, 'RESPONSE_CACHE', 'default')]
+
+
+def get_versions(scopes):
+    """
+    Return the current version counter of each scope, initializing missing ones.
+
+    Counters start from the current time in milliseconds rather than zero, so
+    that a counter lost to eviction or a cache restart can never come back
+    with a value an earlier ETag was built from. They never expire, or every
+    ETag would change whenever the cache's default timeout ran out.
+    """
+    cache = get_cache()
+    keys = [f'version_{scope}' for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, int(time.time() * 1000), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version(*scopes):
+    """
+    Invalidate every cached response that depends on one of the given scopes.
+
+    Args:
+        *scopes (str): The scopes that changed, 'devices' or 'users'.
+    """
+    cache = get_cache()
+    for scope in scopes:
+        try:
+            cache.incr(f'version_{scope}')
+        except ValueError:
+            get_versions([scope])
+
+
+def cache_response(*scopes):
+    """
+    Cache the data of a GET view per endpoint, user, URL arguments and query string.
+
+    The cache key and ETag embed the version counters of the scopes the
+    response depends on, so writes invalidate it by calling bump_version().
+    A request whose If-None-Match matches the current ETag gets a 304 and a
+    cached response is returned as is; neither runs the view body.
+
+    Misses are filled from the primaries: a replica lagging behind a write
+    would otherwise store pre-write data under the post-write version.
+
+    Args:
+        *scopes (str): The scopes the response depends on, 'devices' or 'users'.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            versions = get_versions(scopes)
+            ident = f'{func.__name__}:{request.user.pk}:{sorted(kwargs.items())}:{sorted(request.GET.lists())}:{versions}'
+            digest = hashlib.md5(ident.encode()).hexdigest()
+            etag = quote_etag(digest)
+
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+            cache = get_cache()
+            key = f'response_{digest}'
+            data = cache.get(key)
+            if data is None:
+                with primary_reads():
+                    response = func(request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                # Views on the fast path return an already encoded body
+                data = response.data if isinstance(response, Response) else response.content
+                cache.set(key, data, getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300))
+
+            if isinstance(data, bytes):
+                response = JSONBytesResponse(data)
+                response['ETag'] = etag
+                return response
+            return Response(data, headers={'ETag': etag})
+        return wrapper
+    return decorator
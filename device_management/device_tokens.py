@@ -0,0 +1,157 @@
+import time
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from .models import Device, RevokedDeviceToken
+
+KEY_SALT = 'device_management.device_tokens'
+
+KEYWORD = 'Device'
+
+# Rate limit role of requests authenticated with a device token, see RATE_LIMITS
+DEVICE_ROLE = 'DV'
+
+# (device_id, version) pairs of revoked tokens, per process
+_revoked = set()
+
+# Time and highest RevokedDeviceToken id of the last refresh of _revoked
+_refreshed = [None, 0]
+
+
+def sign(device_id, version):
+    secret = getattr(settings, 'DEVICE_TOKEN_SECRET', None) or settings.SECRET_KEY
+    return salted_hmac(KEY_SALT, f'{device_id}.{version}', secret=secret, algorithm='sha256').hexdigest()
+
+
+def make_token(device):
+    """
+    Build the token of the current version of a device's credentials.
+
+    Args:
+        device (Device): The device.
+
+    Returns:
+        str: The token, '<device id>.<version>.<signature>'.
+    """
+    return f'{device.id}.{device.token_version}.{sign(device.id, device.token_version)}'
+
+
+def refresh_revocations(force=False):
+    """
+    Load the revocations made since the last refresh, at most every DEVICE_TOKEN_REFRESH_INTERVAL seconds.
+
+    Revocations made by this process are applied at once; those of other
+    processes are picked up here, with one query per interval rather than
+    one per request.
+    """
+    now = time.monotonic()
+    interval = getattr(settings, 'DEVICE_TOKEN_REFRESH_INTERVAL', 30)
+    if not force and _refreshed[0] is not None and now - _refreshed[0] < interval:
+        return
+    rows = RevokedDeviceToken.objects.filter(id__gt=_refreshed[1]).order_by('id') \
+        .values_list('id', 'device_id', 'version')
+    for row_id, device_id, version in rows:
+        _revoked.add((device_id, version))
+        _refreshed[1] = row_id
+    _refreshed[0] = now
+
+
+def verify_token(token):
+    """
+    Check the signature of a device token and that it was not revoked.
+
+    Args:
+        token (str): The token presented by the device.
+
+    Returns:
+        int: The ID of the device the token is scoped to.
+
+    Raises:
+        ValueError: If the token is malformed, forged or revoked.
+    """
+    try:
+        device_id, version, signature = token.split('.')
+        device_id, version = int(device_id), int(version)
+    except ValueError:
+        raise ValueError('Malformed device token')
+    if not constant_time_compare(signature, sign(device_id, version)):
+        raise ValueError('Invalid device token')
+    refresh_revocations()
+    if (device_id, version) in _revoked:
+        raise ValueError('Revoked device token')
+    return device_id
+
+
+def revoke(devices):
+    """
+    Revoke the current tokens of the given devices.
+
+    Args:
+        devices (list): (device_id, token_version) pairs.
+    """
+    RevokedDeviceToken.objects.bulk_create(
+        [RevokedDeviceToken(device_id=device_id, version=version) for device_id, version in devices]
+    )
+    _revoked.update(devices)
+
+
+def rotate(device):
+    """
+    Revoke the current token of a device and issue the next one.
+
+    Args:
+        device (Device): The device, loaded from its shard.
+
+    Returns:
+        str: The new token.
+    """
+    devices = Device.objects.using(device._state.db)
+    revoke([(device.id, device.token_version)])
+    # Only move from the version just revoked, so a concurrent rotation cannot leave a live token unrevoked
+    while not devices.filter(id=device.id, token_version=device.token_version) \
+            .update(token_version=device.token_version + 1):
+        device.refresh_from_db(fields=['token_version'])
+        revoke([(device.id, device.token_version)])
+    device.token_version += 1
+    return make_token(device)
+
+
+class DeviceIdentity:
+    """
+    The authenticated principal of a request made with a device token.
+
+    It is scoped to a single device and is not a user: it has no pk and no
+    user role, so only views that explicitly accept devices let it through.
+    """
+    is_authenticated = True
+    is_anonymous = False
+    pk = None
+    role = DEVICE_ROLE
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+
+
+class DeviceTokenAuthentication(BaseAuthentication):
+    """
+    Authenticate devices from an 'Authorization: Device <token>' header without a database query.
+    """
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != KEYWORD.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid device token header')
+        try:
+            token = auth[1].decode()
+            device_id = verify_token(token)
+        except (UnicodeError, ValueError) as e:
+            raise exceptions.AuthenticationFailed(str(e))
+        return DeviceIdentity(device_id), token
+
+    def authenticate_header(self, request):
+        return KEYWORD
@@ -0,0 +1,63 @@
+from django.http import HttpResponse
+
+from .serializers import CustomUserSerializer, DeviceSerializer
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+DEVICE_FIELDS = list(DeviceSerializer.Meta.fields)
+
+# Never expose the password hash on the fast path
+USER_FIELDS = [field for field in CustomUserSerializer.Meta.fields if field != 'password']
+
+
+def row_dicts(queryset, fields):
+    """
+    Fetch the given fields of every row of a queryset as plain dicts.
+
+    Rows are fetched as tuples with values_list(), skipping model instances and
+    serializer fields. Foreign keys are emitted as their id, like the primary
+    key fields of the ModelSerializers do.
+
+    Args:
+        queryset (QuerySet): The rows to fetch.
+        fields (list): The field names, in output order.
+
+    Returns:
+        list: One dict per row.
+    """
+    columns = [queryset.model._meta.get_field(field).attname for field in fields]
+    return [dict(zip(fields, row)) for row in queryset.values_list(*columns)]
+
+
+def encode_rows(queryset, fields):
+    """
+    Encode the given fields of every row of a queryset straight to JSON bytes.
+
+    Args:
+        queryset (QuerySet): The rows to encode.
+        fields (list): The field names, in output order.
+
+    Returns:
+        bytes: A JSON array with one object per row.
+    """
+    return dumps(row_dicts(queryset, fields))
+
+
+class JSONBytesResponse(HttpResponse):
+    """
+    Response for a body that is already encoded as JSON.
+    """
+
+    def __init__(self, content, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content, **kwargs)
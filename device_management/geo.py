@@ -0,0 +1,181 @@
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+GEOHASH_PRECISION = 12
+
+# Upper bound on the number of geohash prefixes a bounding box query is split into
+MAX_CELLS = 32
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Keeps the boxes around a circle small enough for the geohash index to narrow them down
+MAX_RADIUS_KM = 500
+
+# Candidates fetched per result of a radius query, ordered by planar distance before the exact one
+CANDIDATE_FACTOR = 2
+
+DEFAULT_LIMIT = 100
+
+MAX_LIMIT = 1000
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Encode a point as a geohash.
+
+    Args:
+        latitude (float): Latitude in degrees.
+        longitude (float): Longitude in degrees.
+        precision (int): Number of characters.
+
+    Returns:
+        str: The geohash; points in the same cell share its prefixes.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """
+    Return the (latitude, longitude) size in degrees of a geohash cell.
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def cover(min_lat, min_lon, max_lat, max_lon):
+    """
+    Return geohash prefixes whose cells together cover a bounding box.
+
+    The longest prefixes that keep the cover under MAX_CELLS cells are used,
+    so that each prefix is one narrow index range scan.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_size, lon_size = cell_size(precision)
+        rows = math.floor(max_lat / lat_size) - math.floor(min_lat / lat_size) + 1
+        columns = math.floor(max_lon / lon_size) - math.floor(min_lon / lon_size) + 1
+        if rows * columns <= MAX_CELLS:
+            break
+
+    prefixes = set()
+    lat = math.floor(min_lat / lat_size) * lat_size
+    while lat <= max_lat:
+        lon = math.floor(min_lon / lon_size) * lon_size
+        while lon <= max_lon:
+            # Encode the cell centre to avoid landing on a cell boundary
+            prefixes.add(encode(min(lat + lat_size / 2, 90.0), min(lon + lon_size / 2, 180.0), precision))
+            lon += lon_size
+        lat += lat_size
+    return sorted(prefixes)
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points with the haversine formula.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def radius_boxes(latitude, longitude, radius_km):
+    """
+    Return the bounding boxes around a circle, split in two if it crosses the antimeridian.
+
+    Returns:
+        list: (min_lat, min_lon, max_lat, max_lon) tuples.
+    """
+    delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = max(latitude - delta_lat, -90.0)
+    max_lat = min(latitude + delta_lat, 90.0)
+    if min_lat == -90.0 or max_lat == 90.0:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+
+    delta_lon = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(max(abs(min_lat), abs(max_lat))))))
+    if delta_lon >= 180:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    min_lon = longitude - delta_lon
+    max_lon = longitude + delta_lon
+    if min_lon < -180:
+        return [(min_lat, min_lon + 360, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon - 360)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+
+def parse_area(params):
+    """
+    Parse the area of a nearby devices query.
+
+    The area is either a bounding box, from min_lat, min_lon, max_lat and
+    max_lon, or a circle, from lat, lon and radius in kilometres. A box with
+    min_lon greater than max_lon crosses the antimeridian.
+
+    Args:
+        params (QueryDict): The query parameters.
+
+    Returns:
+        tuple: (list of boxes, centre (lat, lon) or None, radius in km or None).
+
+    Raises:
+        ValueError: If the parameters are missing or out of range.
+    """
+    try:
+        if 'radius' in params:
+            latitude, longitude, radius = (float(params[name]) for name in ['lat', 'lon', 'radius'])
+        else:
+            min_lat, min_lon, max_lat, max_lon = (float(params[name])
+                                                  for name in ['min_lat', 'min_lon', 'max_lat', 'max_lon'])
+    except KeyError:
+        raise ValueError('Please provide min_lat, min_lon, max_lat and max_lon, or lat, lon and radius')
+    except ValueError:
+        raise ValueError('Coordinates and radius must be numbers')
+
+    if 'radius' in params:
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError('lat must be within [-90, 90] and lon within [-180, 180]')
+        if not 0 < radius <= MAX_RADIUS_KM:
+            raise ValueError(f'radius must be positive and at most {MAX_RADIUS_KM} km')
+        return radius_boxes(latitude, longitude, radius), (latitude, longitude), radius
+
+    if not (-90 <= min_lat <= max_lat <= 90):
+        raise ValueError('min_lat and max_lat must be within [-90, 90], min_lat first')
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError('min_lon and max_lon must be within [-180, 180]')
+    if min_lon > max_lon:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)], None, None
+    return [(min_lat, min_lon, max_lat, max_lon)], None, None
+
+
+def parse_limit(params):
+    """
+    Parse the maximum number of devices to return, capped at MAX_LIMIT.
+    """
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_LIMIT)
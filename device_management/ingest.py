@@ -0,0 +1,368 @@
+import logging
+import queue
+import time
+from collections import Counter
+
+from django.db import DatabaseError, DataError, IntegrityError, connections, transaction
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .device_tokens import verify_token
+from .loading import copy_rows, loads, parse_row
+from .models import CustomUser, Device
+from .permissions import can_submit_data
+from .sharding import group_by_shard, shard_for_device
+from .webhooks import emit_many
+
+logger = logging.getLogger(__name__)
+
+
+def match_topic(pattern, topic):
+    """
+    Match an MQTT topic against a subscription pattern with + and # wildcards.
+
+    Returns:
+        list: The topic levels matched by + wildcards, or None if it does not match.
+    """
+    levels = topic.split('/')
+    wildcards = []
+    for i, part in enumerate(pattern.split('/')):
+        if part == '#':
+            return wildcards
+        if i >= len(levels) or (part != '+' and part != levels[i]):
+            return None
+        if part == '+':
+            wildcards.append(levels[i])
+    return wildcards if len(levels) == len(pattern.split('/')) else None
+
+
+def topic_device_id(pattern, topic):
+    """
+    Return the device id a topic maps to: the level matched by the first + of the pattern.
+
+    Raises:
+        ValueError: If the topic does not match or the level is not an id.
+    """
+    wildcards = match_topic(pattern, topic)
+    if not wildcards:
+        raise ValueError(f'topic {topic} does not map to a device')
+    return int(wildcards[0])
+
+
+class Authorizer:
+    """
+    Apply the authorization rules of submit_data to MQTT messages.
+
+    A message carries either a device token, checked from its signature, or
+    a user's JWT access token, checked against the device owner like
+    submit_data does. Users and device owners are looked up at most once
+    every ttl seconds.
+    """
+
+    def __init__(self, ttl=60, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.users = {}
+        self.owners = {}
+
+    def authorize(self, token, device_id):
+        if not isinstance(token, str) or not token:
+            return False
+        # Device tokens start with the device id, JWTs with a base64 header
+        if token.split('.', 1)[0].isdigit():
+            try:
+                return verify_token(token) == device_id
+            except ValueError:
+                return False
+        try:
+            user_id = AccessToken(token)[jwt_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            return False
+        user = self.cached(self.users, user_id, lambda: CustomUser.objects.filter(pk=user_id, is_active=True).first())
+        owner_id = self.cached(self.owners, device_id, lambda: Device.objects.using(shard_for_device(device_id))
+                               .filter(id=device_id).values_list('user_id', flat=True).first())
+        return owner_id is not None and can_submit_data(user, owner_id)
+
+    def cached(self, cache, key, load):
+        now = self.clock()
+        hit = cache.get(key)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        value = load()
+        cache[key] = (now + self.ttl, value)
+        return value
+
+
+def write_rows(rows, shard):
+    """
+    Insert validated (device_id, timestamp, data) rows of devices on one shard.
+
+    The rows are written in one transaction, together with their
+    data.created events. If the database rejects the rows themselves,
+    because a device was deleted since its message was authorized or a
+    payload is refused, the rows of existing devices are retried together,
+    then one by one, and those failing again are dropped.
+
+    Returns:
+        tuple: The number of rows written and of rows dropped.
+
+    Raises:
+        DatabaseError: If the shard failed otherwise, e.g. a lost connection; nothing was written.
+    """
+    if try_insert(rows, shard):
+        return len(rows), 0
+    existing = set(Device.objects.using(shard).filter(id__in={row[0] for row in rows}).values_list('id', flat=True))
+    kept = [row for row in rows if row[0] in existing]
+    if len(kept) < len(rows) and try_insert(kept, shard):
+        return len(kept), len(rows) - len(kept)
+    written = sum(try_insert([row], shard) for row in kept)
+    return written, len(rows) - written
+
+
+def try_insert(rows, shard):
+    """
+    Insert rows with their events in one transaction, returning False if the database rejects the rows.
+    """
+    try:
+        with transaction.atomic(using=shard):
+            copy_rows(rows, shard)
+            emit_many('data.created', [{'device': device_id, 'timestamp': timestamp.isoformat(), 'data': data}
+                                       for device_id, timestamp, data in rows], shard)
+    except (IntegrityError, DataError):
+        return False
+    return True
+
+
+def close_broken_connections():
+    """
+    Drop the connections a database error left broken, so the next query reconnects.
+    """
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+
+
+class BatchWriter:
+    """
+    Buffer rows and insert them once batch_size rows are pending or the oldest has waited flush_interval seconds.
+
+    Rows the database rejects are dropped and counted. The rows of a shard
+    that cannot be written, e.g. while its connection is down, are put back
+    and retried after flush_interval, so an outage delays rows instead of
+    losing the batch or stopping the worker.
+    """
+
+    def __init__(self, batch_size=1000, flush_interval=1.0, clock=time.monotonic):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.rows = []
+        self.oldest = None
+        self.written = 0
+        self.dropped = 0
+        self.retries = 0
+        self.retry_at = None
+
+    def add(self, row):
+        if not self.rows:
+            self.oldest = self.clock()
+        self.rows.append(row)
+        # Requeued rows wait for their retry even when they fill a batch
+        if len(self.rows) >= self.batch_size and (self.retry_at is None or self.clock() >= self.retry_at):
+            self.flush()
+
+    def timeout(self):
+        """
+        Return how long to wait for messages before the pending rows are due.
+        """
+        if not self.rows:
+            return self.flush_interval
+        return max(0.0, self.oldest + self.flush_interval - self.clock())
+
+    def due(self):
+        return bool(self.rows) and self.clock() - self.oldest >= self.flush_interval
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows, self.oldest = self.rows, [], None
+        rows_by_device = {}
+        for row in rows:
+            rows_by_device.setdefault(row[0], []).append(row)
+
+        failed = []
+        for shard, device_ids in group_by_shard(rows_by_device).items():
+            shard_rows = [row for device_id in device_ids for row in rows_by_device[device_id]]
+            try:
+                written, dropped = write_rows(shard_rows, shard)
+            except DatabaseError:
+                logger.exception('Writing %d rows to %s failed, retrying in %ss',
+                                 len(shard_rows), shard, self.flush_interval)
+                close_broken_connections()
+                failed.extend(shard_rows)
+                continue
+            self.written += written
+            self.dropped += dropped
+
+        self.retry_at = None
+        if failed:
+            self.retries += 1
+            self.rows = failed
+            # Due again once flush_interval has passed
+            self.oldest = self.clock()
+            self.retry_at = self.oldest + self.flush_interval
+
+
+class IngestWorker:
+    """
+    Consume device readings from MQTT and insert them in batches.
+
+    Messages are JSON objects with a token (device token or user JWT), data
+    and an optional ISO 8601 timestamp, published on a topic that maps to the
+    device id, e.g. devices/42/data for the pattern devices/+/data.
+    """
+
+    def __init__(self, client, topic, authorizer=None, writer=None, qos=1):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.authorizer = authorizer or Authorizer()
+        self.writer = writer or BatchWriter()
+        self.received = 0
+        self.rejects = Counter()
+        client.on_message = self.handle_message
+
+    def handle_message(self, topic, payload):
+        self.received += 1
+        try:
+            device_id = topic_device_id(self.topic, topic)
+            message = loads(payload)
+            if not isinstance(message, dict):
+                raise ValueError('message is not a JSON object')
+            if not self.authorizer.authorize(message.get('token'), device_id):
+                raise ValueError('not authorized')
+            row = {'device_id': device_id, 'data': message.get('data'), 'timestamp': message.get('timestamp')}
+            self.writer.add(parse_row(row, {device_id}))
+        except (ValueError, TypeError) as e:
+            # Reasons only, the payloads may carry tokens
+            self.rejects[str(e).split(':')[0]] += 1
+        except DatabaseError:
+            # Authorizing needed a query that failed, the message cannot be checked
+            logger.exception('Authorizing a message failed')
+            close_broken_connections()
+            self.rejects['database error'] += 1
+
+    def run(self, stopped, report=None, report_interval=60):
+        """
+        Consume messages until stopped() returns True, then flush what is pending.
+
+        Args:
+            stopped (callable): Returns True once the worker should stop.
+            report (callable): Called with the worker every report_interval seconds.
+            report_interval (float): Seconds between reports.
+        """
+        self.client.subscribe(self.topic, self.qos)
+        self.client.connect()
+        reported = time.monotonic()
+        try:
+            while not stopped():
+                self.client.loop(self.writer.timeout())
+                if self.writer.due():
+                    self.writer.flush()
+                if report and time.monotonic() - reported >= report_interval:
+                    report(self)
+                    reported = time.monotonic()
+        finally:
+            self.writer.flush()
+            self.client.disconnect()
+
+
+class PahoClient:
+    """
+    Broker connection through paho-mqtt, which is only needed by the mqtt_ingest worker.
+
+    The session is persistent (clean_session off) so the broker keeps QoS 1
+    messages while the worker restarts; subscriptions are renewed on every
+    reconnect.
+    """
+
+    def __init__(self, host, port, client_id, username=None, password=None, keepalive=60):
+        try:
+            import paho.mqtt.client as mqtt
+        except ImportError:
+            raise ImportError('mqtt_ingest needs paho-mqtt, install it with pip install paho-mqtt')
+
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            self.mqtt = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=False)
+        else:
+            self.mqtt = mqtt.Client(client_id=client_id, clean_session=False)
+        if username:
+            self.mqtt.username_pw_set(username, password)
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.subscriptions = []
+        self.on_message = None
+        self.mqtt.on_connect = self.subscribe_all
+        self.mqtt.on_message = lambda client, userdata, message: self.on_message(message.topic, message.payload)
+
+    def subscribe_all(self, *args):
+        for topic, qos in self.subscriptions:
+            self.mqtt.subscribe(topic, qos)
+
+    def subscribe(self, topic, qos=1):
+        self.subscriptions.append((topic, qos))
+
+    def connect(self):
+        self.mqtt.connect(self.host, self.port, self.keepalive)
+
+    def loop(self, timeout):
+        if self.mqtt.loop(timeout) != 0:
+            try:
+                self.mqtt.reconnect()
+            except OSError:
+                time.sleep(1)
+
+    def disconnect(self):
+        self.mqtt.disconnect()
+
+
+class QueueClient:
+    """
+    In-process stand-in for a broker connection, for tests and local runs.
+
+    Messages passed to publish() are delivered to the subscriber from loop(),
+    like a broker would.
+    """
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.subscriptions = []
+        self.on_message = None
+
+    def publish(self, topic, payload):
+        self.messages.put((topic, payload))
+
+    def subscribe(self, topic, qos=1):
+        self.subscriptions.append(topic)
+
+    def connect(self):
+        pass
+
+    def loop(self, timeout):
+        try:
+            message = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while message is not None:
+            topic, payload = message
+            if any(match_topic(pattern, topic) is not None for pattern in self.subscriptions):
+                self.on_message(topic, payload)
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                message = None
+
+    def disconnect(self):
+        pass
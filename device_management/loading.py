@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+import math
+from datetime import timezone as dt_timezone
+
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Data
+
+
+def finite_float(text):
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError('out of range float value')
+    return value
+
+
+def reject_constant(name):
+    raise ValueError('out of range float value')
+
+
+def reject_nul(value):
+    """
+    Raise ValueError if a decoded JSON value holds a NUL character in a string or key.
+    """
+    if isinstance(value, str):
+        if '\x00' in value:
+            raise ValueError('NUL character in string')
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            reject_nul(key)
+            reject_nul(item)
+    elif isinstance(value, list):
+        for item in value:
+            reject_nul(item)
+
+
+def loads(text):
+    """
+    Decode JSON for the data column, refusing what jsonb rejects.
+
+    NaN and infinite numbers are invalid like in the API, and so are NUL
+    characters (\\u0000) in strings.
+
+    Raises:
+        ValueError: If the text is not valid JSON or has such values.
+    """
+    value = json.loads(text, parse_float=finite_float, parse_constant=reject_constant)
+    reject_nul(value)
+    return value
+
+
+def parse_row(row, device_ids):
+    """
+    Validate a single parsed record.
+
+    Args:
+        row (dict): The record with device_id, data and an optional timestamp.
+        device_ids (set): IDs of the devices that exist.
+
+    Returns:
+        tuple: (device_id, timestamp, data) ready to load.
+
+    Raises:
+        ValueError: If the record is invalid or references an unknown device.
+    """
+    try:
+        device_id = int(row['device_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('missing or invalid device_id')
+    if device_id not in device_ids:
+        raise ValueError(f'unknown device {device_id}')
+
+    data = row.get('data')
+    if isinstance(data, str):
+        data = loads(data)
+    if data is None or data == '':
+        raise ValueError('missing data')
+
+    timestamp = row.get('timestamp')
+    if timestamp:
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError('invalid timestamp')
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    else:
+        timestamp = timezone.now()
+
+    return device_id, timestamp, data
+
+
+def copy_rows(rows, using):
+    """
+    Load validated rows into the Data table of a database, using COPY on PostgreSQL.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        Data.objects.using(using).bulk_create(
+            [Data(device_id=device_id, timestamp=timestamp, data=data) for device_id, timestamp, data in rows]
+        )
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for device_id, timestamp, data in rows:
+        writer.writerow([device_id, timestamp.isoformat(), json.dumps(data)])
+    buffer.seek(0)
+
+    # The raw psycopg2 cursor bypasses Django's error wrapping, which callers rely on
+    with connection.cursor() as cursor, connection.wrap_database_errors:
+        cursor.cursor.copy_expert(
+            f'COPY {Data._meta.db_table} (device_id, timestamp, data) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from device_management.fastpath import DEVICE_FIELDS, USER_FIELDS, dumps
+from device_management.models import CustomUser, Device
+from device_management.serializers import CustomUserSerializer, DeviceSerializer
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+class Command(BaseCommand):
+    help = 'Compare the ModelSerializer and values_list() fast paths of the device and user list endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        # Rows are built in memory so that only serialization and encoding are measured
+        for rows in options['rows']:
+            devices = [Device(id=i, user_id=i % 100, name=f'Device {i}', location=f'Location {i}',
+                              latitude=(i % 180) - 90.0, longitude=(i % 360) - 180.0) for i in range(rows)]
+            columns = [Device._meta.get_field(field).attname for field in DEVICE_FIELDS]
+            device_tuples = [tuple(getattr(device, column) for column in columns) for device in devices]
+            users = [CustomUser(id=i, username=f'user{i}', password='x' * 88, email=f'user{i}@example.com', role='LO')
+                     for i in range(rows)]
+            user_tuples = [(user.id, user.username, user.email, user.role) for user in users]
+
+            cases = [
+                ('devices', DeviceSerializer, devices, DEVICE_FIELDS, device_tuples),
+                ('users', CustomUserSerializer, users, USER_FIELDS, user_tuples),
+            ]
+            for name, serializer_class, objects, fields, tuples in cases:
+                serializer_time = best_of(
+                    options['repeat'],
+                    lambda: JSONRenderer().render(serializer_class(objects, many=True).data),
+                )
+                fast_time = best_of(
+                    options['repeat'],
+                    lambda: dumps([dict(zip(fields, row)) for row in tuples]),
+                )
+                self.stdout.write(
+                    f'{name:8} {rows:>9} rows  serializer {serializer_time:8.3f}s  '
+                    f'fast path {fast_time:8.3f}s  speedup {serializer_time / fast_time:5.1f}x'
+                )
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from device_management.models import Device, Data
+from device_management.sharding import SHARD_ID_BLOCK, get_shards
+
+
+class Command(BaseCommand):
+    help = 'Move the Device and Data id sequences of every shard to the id block of that shard.'
+
+    def handle(self, *args, **options):
+        for index, alias in enumerate(get_shards()):
+            if alias not in connections.databases:
+                raise CommandError(f'Shard {alias} is not configured in DATABASES')
+            floor = index * SHARD_ID_BLOCK
+            connection = connections[alias]
+            with connection.cursor() as cursor:
+                for model in (Device, Data):
+                    table = model._meta.db_table
+                    if connection.vendor == 'postgresql':
+                        cursor.execute(
+                            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                            f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {table})) + 1, false)",
+                            [table, floor],
+                        )
+                    elif connection.vendor == 'sqlite':
+                        cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [table])
+                        cursor.execute(
+                            f'INSERT INTO sqlite_sequence (name, seq) '
+                            f'SELECT %s, MAX(%s, COALESCE(MAX(id), 0)) FROM {table}',
+                            [table, floor],
+                        )
+                    else:
+                        raise CommandError(f'Unsupported database vendor {connection.vendor}')
+            self.stdout.write(f'{alias}: ids start above {floor}')
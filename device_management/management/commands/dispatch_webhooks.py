@@ -0,0 +1,42 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from device_management.webhooks import Dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver the outbox events to the webhook subscriptions in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events per delivery')
+        parser.add_argument('--workers', type=int, default=8, help='Deliveries in flight across all endpoints')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for an endpoint')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the outbox is drained')
+        parser.add_argument('--prune-interval', type=float, default=60,
+                            help='Seconds between deletions of the events every subscription received')
+        parser.add_argument('--once', action='store_true', help='Run a single round and exit')
+
+    def handle(self, *args, **options):
+        dispatcher = Dispatcher(options['batch_size'], options['workers'], options['timeout'])
+        if options['once']:
+            delivered = dispatcher.run_once()
+            dispatcher.prune()
+            self.stdout.write(f'Delivered {delivered} events')
+            return
+
+        stop = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.append(True))
+
+        pruned = time.monotonic()
+        while not stop:
+            delivered = dispatcher.run_once()
+            if options['verbosity'] > 1 and delivered:
+                self.stdout.write(f'Delivered {delivered} events')
+            if time.monotonic() - pruned >= options['prune_interval']:
+                dispatcher.prune()
+                pruned = time.monotonic()
+            if not delivered:
+                time.sleep(options['interval'])
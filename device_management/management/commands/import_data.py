@@ -0,0 +1,208 @@
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from device_management.loading import copy_rows, loads, parse_row
+from device_management.models import Device
+from device_management.sharding import get_shards, group_by_shard
+
+# IDs of the existing devices, set once per worker process by init_worker()
+_device_ids = set()
+
+
+def split_file(path, chunk_size):
+    """
+    Split a file into byte ranges that start and end on line boundaries.
+
+    Args:
+        path (str): Path of the input file.
+        chunk_size (int): Approximate size of each range in bytes.
+
+    Returns:
+        list: A list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def read_rows(path, start, end, fmt, header):
+    """
+    Yield (line_number_hint, record) pairs for the lines in a byte range.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start).decode('utf-8')
+
+    if fmt == 'csv':
+        # csv handles the line endings itself, so quoted fields may span lines
+        records = csv.reader(io.StringIO(raw, newline=''))
+        if start == 0:
+            next(records, None)
+        for offset, values in enumerate(records):
+            if values:
+                yield offset, dict(zip(header, values))
+    else:
+        # Split on newlines only, like split_file: JSON strings may hold U+2028 and other line breaks
+        lines = raw.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        for offset, line in enumerate(lines):
+            if line.strip():
+                try:
+                    yield offset, loads(line)
+                except ValueError:
+                    yield offset, None
+
+
+def init_worker(device_ids):
+    """
+    Receive the IDs of the existing devices once per worker rather than with every chunk.
+    """
+    global _device_ids
+    _device_ids = device_ids
+
+
+def import_chunk(path, start, end, fmt, header, batch_size):
+    """
+    Parse, validate and load one byte range of the input file.
+
+    The whole range is loaded in one transaction per shard so that a
+    checkpointed chunk is either fully imported or not imported at all, short
+    of a failure between the commits of two shards.
+
+    Returns:
+        tuple: (start, rows loaded, list of (line offset, reason) rejects).
+    """
+    loaded = 0
+    rejects = []
+    batch = []
+    try:
+        with ExitStack() as stack:
+            for shard in get_shards():
+                stack.enter_context(transaction.atomic(using=shard))
+            for offset, record in read_rows(path, start, end, fmt, header):
+                if record is None:
+                    rejects.append((offset, 'invalid JSON'))
+                    continue
+                try:
+                    batch.append(parse_row(record, _device_ids))
+                except (ValueError, TypeError) as e:
+                    rejects.append((offset, str(e)))
+                    continue
+                if len(batch) >= batch_size:
+                    loaded += copy_batch(batch)
+                    batch = []
+            if batch:
+                loaded += copy_batch(batch)
+    finally:
+        connections.close_all()
+    return start, loaded, rejects
+
+
+def copy_batch(batch):
+    """
+    Load a batch of validated rows into the shards of their devices.
+
+    Returns:
+        int: The number of rows loaded.
+    """
+    rows_by_device = {}
+    for row in batch:
+        rows_by_device.setdefault(row[0], []).append(row)
+    for shard, device_ids in group_by_shard(rows_by_device).items():
+        copy_rows([row for device_id in device_ids for row in rows_by_device[device_id]], shard)
+    return len(batch)
+
+
+class Command(BaseCommand):
+    help = 'Bulk import historical device readings from JSONL or CSV files into Data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONL or CSV file with device_id, timestamp and data fields')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='Input format (default: from file extension)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-size', type=int, default=16 * 1024 * 1024, help='Bytes per work unit')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per COPY batch')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: <path>.checkpoint)')
+        parser.add_argument('--rejects', help='Write rejected lines to this file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        header = None
+        if fmt == 'csv':
+            with open(path, newline='') as f:
+                header = next(csv.reader(f), None)
+            if not header or 'device_id' not in header or 'data' not in header:
+                raise CommandError('CSV input needs a header with at least device_id and data')
+
+        checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        done = set()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('chunk_size') == options['chunk_size']:
+                done = set(checkpoint['completed'])
+            else:
+                self.stderr.write('Ignoring checkpoint written with a different --chunk-size')
+
+        chunks = [chunk for chunk in split_file(path, options['chunk_size']) if chunk[0] not in done]
+        device_ids = set()
+        for shard in get_shards():
+            device_ids.update(Device.objects.using(shard).values_list('id', flat=True))
+
+        # Workers open their own connections; do not share the parent's across fork
+        connections.close_all()
+
+        loaded = 0
+        rejected = 0
+        started = time.monotonic()
+        rejects_file = open(options['rejects'], 'a') if options['rejects'] else None
+        try:
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker,
+                                     initargs=(device_ids,)) as executor:
+                futures = [
+                    executor.submit(import_chunk, path, start, end, fmt, header, options['batch_size'])
+                    for start, end in chunks
+                ]
+                for future in as_completed(futures):
+                    start, rows, rejects = future.result()
+                    loaded += rows
+                    rejected += len(rejects)
+                    done.add(start)
+                    if rejects_file:
+                        for offset, reason in rejects:
+                            rejects_file.write(f'{start}+{offset}\t{reason}\n')
+                    with open(checkpoint_path, 'w') as f:
+                        json.dump({'chunk_size': options['chunk_size'], 'completed': sorted(done)}, f)
+                    if options['verbosity'] > 1:
+                        elapsed = time.monotonic() - started
+                        self.stdout.write(f'{loaded} rows, {rejected} rejects, {loaded / elapsed:.0f} rows/sec')
+        finally:
+            if rejects_file:
+                rejects_file.close()
+
+        elapsed = time.monotonic() - started
+        rate = loaded / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {loaded} rows ({rejected} rejected) in {elapsed:.1f}s, {rate:.0f} rows/sec'
+        ))
@@ -0,0 +1,57 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from device_management.ingest import Authorizer, BatchWriter, IngestWorker, PahoClient
+
+
+class Command(BaseCommand):
+    help = 'Consume device readings from an MQTT broker and batch-insert them into Data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=settings.MQTT_HOST)
+        parser.add_argument('--port', type=int, default=settings.MQTT_PORT)
+        parser.add_argument('--username', default=settings.MQTT_USERNAME)
+        parser.add_argument('--password', default=settings.MQTT_PASSWORD)
+        parser.add_argument('--client-id', default='mqtt_ingest', help='Stable id of the persistent session')
+        parser.add_argument('--topic', default=settings.MQTT_TOPIC,
+                            help='Subscription whose first + level is the device id')
+        parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=1)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per insert')
+        parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='Seconds a reading may wait for its batch to fill')
+        parser.add_argument('--auth-ttl', type=float, default=60,
+                            help='Seconds users and device owners are cached for JWT-authorized messages')
+
+    def handle(self, *args, **options):
+        if '+' not in options['topic'].split('/'):
+            raise CommandError('--topic needs a + level for the device id, e.g. devices/+/data')
+        try:
+            client = PahoClient(options['host'], options['port'], options['client_id'],
+                                options['username'], options['password'])
+        except ImportError as e:
+            raise CommandError(str(e))
+
+        worker = IngestWorker(
+            client, options['topic'],
+            authorizer=Authorizer(ttl=options['auth_ttl']),
+            writer=BatchWriter(options['batch_size'], options['flush_interval']),
+            qos=options['qos'],
+        )
+
+        stop = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.append(True))
+
+        self.stdout.write(f'Consuming {options["topic"]} from {options["host"]}:{options["port"]}')
+        worker.run(lambda: bool(stop), report=self.report if options['verbosity'] > 1 else None)
+        self.report(worker)
+
+    def report(self, worker):
+        rejects = ', '.join(f'{reason}: {count}' for reason, count in worker.rejects.most_common())
+        writer = worker.writer
+        self.stdout.write(f'{worker.received} messages, {writer.written} rows written'
+                          + (f', rejected {rejects}' if rejects else '')
+                          + (f', {writer.dropped} rows refused by the database' if writer.dropped else '')
+                          + (f', {writer.retries} failed writes retried' if writer.retries else ''))
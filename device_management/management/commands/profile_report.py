@@ -0,0 +1,81 @@
+import io
+import json
+import pstats
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def load_sql(paths):
+    """
+    Sum up the queries recorded alongside a set of profiles.
+
+    Args:
+        paths (list): The .prof files; their .sql.json files are read when present.
+
+    Returns:
+        tuple: Request times, and per SQL statement its (count, total time).
+    """
+    times = []
+    statements = defaultdict(lambda: [0, 0.0])
+    for path in paths:
+        sql_path = path.with_name(path.name[:-len('.prof')] + '.sql.json')
+        if not sql_path.exists():
+            continue
+        with open(sql_path) as f:
+            record = json.load(f)
+        times.append(record['time'])
+        for query in record['queries']:
+            # Queries are recorded before parameter interpolation, so identical statements group together
+            statement = statements[' '.join(query['sql'].split())]
+            statement[0] += 1
+            statement[1] += query['time']
+    return times, statements
+
+
+class Command(BaseCommand):
+    help = 'Aggregate the profiles written by ProfilingMiddleware into the top hot spots per endpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=str(getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles')))
+        parser.add_argument('--endpoint', action='append', help='Only report these URL names (repeatable)')
+        parser.add_argument('--sort', choices=['tottime', 'cumulative', 'ncalls'], default='tottime')
+        parser.add_argument('--limit', type=int, default=15, help='Functions and statements shown per endpoint')
+
+    def handle(self, *args, **options):
+        directory = Path(options['dir'])
+        if not directory.is_dir():
+            raise CommandError(f'No profiles in {directory}')
+
+        endpoints = sorted(path for path in directory.iterdir() if path.is_dir())
+        if options['endpoint']:
+            endpoints = [path for path in endpoints if path.name in options['endpoint']]
+        for endpoint in endpoints:
+            paths = sorted(endpoint.glob('*.prof'))
+            if paths:
+                self.report(endpoint.name, paths, options['sort'], options['limit'])
+
+    def report(self, endpoint, paths, sort, limit):
+        times, statements = load_sql(paths)
+        header = f'{endpoint}: {len(paths)} profiled requests'
+        if times:
+            times.sort()
+            header += f', median {times[len(times) // 2] * 1000:.1f} ms, max {times[-1] * 1000:.1f} ms'
+        self.stdout.write(self.style.MIGRATE_HEADING(header))
+
+        output = io.StringIO()
+        stats = pstats.Stats(*map(str, paths), stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        # Skip the pstats preamble, down to the table header
+        lines = output.getvalue().splitlines()
+        start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+        self.stdout.write('\n'.join(line for line in lines[start:] if line.strip()))
+
+        if statements:
+            self.stdout.write('\n   count   total ms  statement')
+            top = sorted(statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+            for sql, (count, total) in top:
+                self.stdout.write(f'{count:8} {total * 1000:10.1f}  {sql[:200]}')
+        self.stdout.write('')
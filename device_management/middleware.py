@@ -0,0 +1,110 @@
+import cProfile
+import itertools
+import json
+import os
+import random
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+
+from .replicas import mark_write, read_only_request
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Tells apart the profiles written in the same second by a process
+_profiles = itertools.count()
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Let read-only requests read from replicas and pin users to the primaries after they write.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in SAFE_METHODS:
+            with read_only_request(request):
+                return self.get_response(request)
+
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        # Devices authenticated with their own token have no pk and never read back
+        if response.status_code < 400 and user is not None and user.is_authenticated and user.pk is not None:
+            mark_write(user.pk)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile sampled requests, and requests carrying the profiling header, into PROFILING_DIR.
+
+    A profiled request runs under cProfile with every SQL query recorded. Its
+    stats are written as <endpoint>/<time>-<pid>.prof, readable by pstats,
+    snakeviz or flameprof, with the queries in a .sql.json file next to it;
+    see the profile_report command. The header must carry PROFILING_TOKEN.
+    Unless a sample rate or a token is configured the middleware unloads
+    itself at startup, so it costs nothing when inactive.
+    """
+
+    def __init__(self, get_response):
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        self.token = getattr(settings, 'PROFILING_TOKEN', None)
+        if not self.sample_rate and not self.token:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.directory = Path(getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles'))
+        self.header = 'HTTP_' + getattr(settings, 'PROFILING_HEADER', 'X-Profile').upper().replace('-', '_')
+
+    def __call__(self, request):
+        if not self.wanted(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({'alias': context['connection'].alias, 'sql': sql,
+                                'time': time.perf_counter() - started})
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(record))
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another request of this process is being profiled
+                return self.get_response(request)
+            started = time.perf_counter()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.url_name if match and match.url_name else 'unresolved'
+        path = self.directory / endpoint / f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{next(_profiles)}'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(f'{path}.prof')
+        with open(f'{path}.sql.json', 'w') as f:
+            json.dump({'method': request.method, 'path': request.path, 'status': response.status_code,
+                       'time': elapsed, 'queries': queries}, f)
+        response['X-Profile-Id'] = f'{endpoint}/{path.name}'
+        return response
+
+    def wanted(self, request):
+        header = request.META.get(self.header)
+        if header is not None and self.token:
+            return constant_time_compare(header, self.token)
+        return self.sample_rate and random.random() < self.sample_rate
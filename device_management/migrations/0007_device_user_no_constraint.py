@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_management', '0006_alter_data_timestamp'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='device',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:11
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_management', '0007_device_user_no_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.AddIndex(
+            model_name='data',
+            index=models.Index(fields=['device', '-timestamp'], name='data_device_latest_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+INDEX_NAME = 'data_payload_path_ops_idx'
+
+
+def create_index(apps, schema_editor):
+    # GIN and jsonb_path_ops only exist on PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('device_management', 'Data')._meta.db_table
+    schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {table} USING gin (data jsonb_path_ops)')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_management', '0008_device_coordinates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_management', '0009_data_payload_gin_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedDeviceToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.BigIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('revoked_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='token_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
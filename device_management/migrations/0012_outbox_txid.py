@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+def cursors_to_pairs(apps, schema_editor):
+    # Events written before this migration get txid 0, so they keep their order
+    WebhookSubscription = apps.get_model('device_management', 'WebhookSubscription')
+    subscriptions = WebhookSubscription.objects.using(schema_editor.connection.alias)
+    for subscription in subscriptions:
+        subscription.cursors = {alias: cursor if isinstance(cursor, list) else [0, cursor]
+                                for alias, cursor in subscription.cursors.items()}
+        subscription.save(update_fields=['cursors'])
+
+
+def cursors_to_ids(apps, schema_editor):
+    WebhookSubscription = apps.get_model('device_management', 'WebhookSubscription')
+    subscriptions = WebhookSubscription.objects.using(schema_editor.connection.alias)
+    for subscription in subscriptions:
+        subscription.cursors = {alias: cursor[1] if isinstance(cursor, list) else cursor
+                                for alias, cursor in subscription.cursors.items()}
+        subscription.save(update_fields=['cursors'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_management', '0011_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='txid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['txid', 'id'], name='outbox_delivery_order_idx'),
+        ),
+        migrations.RunPython(cursors_to_pairs, cursors_to_ids),
+    ]
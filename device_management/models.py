@@ -1,8 +1,11 @@
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from timescale.db.models.fields import TimescaleDateTimeField
 from django.utils import timezone
 
+from .geo import GEOHASH_PRECISION, encode
+
 
 class CustomUser(AbstractUser):
     ROLE_CHOICES = (
@@ -17,12 +20,79 @@ class CustomUser(AbstractUser):
 
 
 class Device(models.Model):
-    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    # Devices may live on another database than their owner, see sharding.py
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, db_constraint=False)
     name = models.CharField(max_length=200)
     location = models.CharField(max_length=200)
+    latitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # Derived from the coordinates on save; prefix range scans on its B-tree index find nearby devices
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, null=True, blank=True, editable=False, db_index=True)
+    # Version of the current device token; every rotation revokes the previous one
+    token_version = models.PositiveIntegerField(default=1, editable=False)
+
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode(self.latitude, self.longitude)
+        else:
+            self.geohash = None
+        if kwargs.get('update_fields') is not None and {'latitude', 'longitude'} & set(kwargs['update_fields']):
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'geohash'}
+        super().save(*args, **kwargs)
 
 
 class Data(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE)
     timestamp = TimescaleDateTimeField(interval="1 day", default=timezone.now)
     data = models.JSONField()
+
+    class Meta:
+        indexes = [
+            # Latest reading of a device without scanning its whole history
+            models.Index(fields=['device', '-timestamp'], name='data_device_latest_idx'),
+        ]
+
+
+class RevokedDeviceToken(models.Model):
+    # Devices may live on another database, see sharding.py
+    device_id = models.BigIntegerField()
+    version = models.PositiveIntegerField()
+    revoked_at = models.DateTimeField(default=timezone.now)
+
+
+class OutboxEvent(models.Model):
+    # Written on the database of the change it records, in the same transaction, see webhooks.py
+    type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+    # Id of the writing transaction on PostgreSQL, 0 elsewhere; events are delivered in (txid, id) order
+    txid = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['txid', 'id'], name='outbox_delivery_order_idx'),
+        ]
+
+
+class WebhookSubscription(models.Model):
+    EVENT_TYPES = (
+        'data.created',
+        'device.created',
+        'device.updated',
+        'device.deleted',
+        'user.updated',
+        'user.deleted',
+    )
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    url = models.URLField(max_length=500)
+    secret = models.CharField(max_length=64, editable=False)
+    # Event types to deliver, all of them when empty
+    events = models.JSONField(default=list, blank=True)
+    # Batches in flight to this endpoint at once
+    max_concurrency = models.PositiveSmallIntegerField(default=2)
+    is_active = models.BooleanField(default=True)
+    # Per database, the [txid, id] of the last OutboxEvent handled for this subscription
+    cursors = models.JSONField(default=dict, editable=False)
+    failures = models.PositiveIntegerField(default=0, editable=False)
+    next_attempt_at = models.DateTimeField(null=True, blank=True, editable=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
@@ -1,6 +1,13 @@
 from rest_framework import permissions
 
 
+def can_submit_data(user, owner_id):
+    """
+    Whether a user may submit readings for a device owned by owner_id; shared by every ingestion path.
+    """
+    return user is not None and owner_id == user.pk and user.role in ['LM', 'OW']
+
+
 class IsLO(permissions.BasePermission):
     def has_permission(self, request, view):
         return request.user.role in ['LO', 'LE', 'LM', 'OW']
@@ -19,3 +26,8 @@ class IsLM(permissions.BasePermission):
 class IsOW(permissions.BasePermission):
     def has_permission(self, request, view):
         return request.user.role in ['OW']
+
+
+class IsDevice(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.user.role in ['DV']
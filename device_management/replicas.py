@@ -0,0 +1,149 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.functional import LazyObject
+
+from .sharding import ShardRouter
+
+_read_request = ContextVar('read_request', default=None)
+
+# alias -> (checked at, healthy), per process
+_health = {}
+
+LAG_SQL = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+def get_replicas(alias):
+    return getattr(settings, 'DATABASE_REPLICAS', {}).get(alias, [])
+
+
+def primary_of(alias):
+    """
+    Return the primary database of a replica alias, or the alias itself.
+    """
+    for primary, replicas in getattr(settings, 'DATABASE_REPLICAS', {}).items():
+        if alias in replicas:
+            return primary
+    return alias
+
+
+def is_healthy(alias):
+    """
+    Check that a replica answers and lags less than REPLICA_MAX_LAG seconds behind.
+
+    The result is kept for REPLICA_CHECK_INTERVAL seconds so that routing a
+    query usually costs a dict lookup.
+    """
+    now = time.monotonic()
+    checked = _health.get(alias)
+    if checked and now - checked[0] < getattr(settings, 'REPLICA_CHECK_INTERVAL', 5):
+        return checked[1]
+
+    try:
+        with connections[alias].cursor() as cursor:
+            if connections[alias].vendor == 'postgresql':
+                cursor.execute(LAG_SQL)
+                lag = cursor.fetchone()[0] or 0
+            else:
+                cursor.execute('SELECT 1')
+                lag = 0
+        healthy = lag <= getattr(settings, 'REPLICA_MAX_LAG', 5)
+    except DatabaseError:
+        healthy = False
+    _health[alias] = (now, healthy)
+    return healthy
+
+
+def mark_write(user_id):
+    """
+    Pin the reads of a user to the primaries for READ_YOUR_WRITES_WINDOW seconds.
+    """
+    window = getattr(settings, 'READ_YOUR_WRITES_WINDOW', 10)
+    cache.set(f'last_write_{user_id}', True, window)
+
+
+def _pinned(state):
+    if 'pinned' not in state:
+        # DRF replaces the lazy session user once the request is authenticated
+        user = state['request'].__dict__.get('user')
+        if user is None or isinstance(user, LazyObject):
+            # Not authenticated yet, e.g. the token user lookup itself
+            return True
+        state['pinned'] = bool(user.is_authenticated and cache.get(f'last_write_{user.pk}'))
+    return state['pinned']
+
+
+def replica_for(alias):
+    """
+    Return the database to read from instead of a primary alias.
+
+    Outside a read-only request, for a user who wrote recently, or when no
+    configured replica is healthy, this is the primary itself.
+    """
+    replicas = get_replicas(alias)
+    state = _read_request.get()
+    if not replicas or state is None or _pinned(state):
+        return alias
+    healthy = [replica for replica in replicas if is_healthy(replica)]
+    return random.choice(healthy) if healthy else alias
+
+
+@contextmanager
+def read_only_request(request):
+    """
+    Allow the reads made while handling a request to go to replicas.
+    """
+    token = _read_request.set({'request': request})
+    try:
+        yield
+    finally:
+        _read_request.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads made inside the block to the primaries, even during a read-only request.
+
+    For reads whose results outlive the request, such as cached responses,
+    which must not capture the state of a lagging replica.
+    """
+    token = _read_request.set(None)
+    try:
+        yield
+    finally:
+        _read_request.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Send reads made during read-only requests to a healthy replica of the primary they would use.
+
+    Must come before ShardRouter in DATABASE_ROUTERS; writes are left to it.
+    """
+    shard_router = ShardRouter()
+
+    def db_for_read(self, model, **hints):
+        if _read_request.get() is None:
+            return None
+        primary = self.shard_router.db_for_read(model, **hints) or DEFAULT_DB_ALIAS
+        return replica_for(primary_of(primary))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if primary_of(obj1._state.db) == primary_of(obj2._state.db):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive their schema through replication
+        if primary_of(db) != db:
+            return False
+        return None
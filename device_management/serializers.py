@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import CustomUser, Device, Data
+from .models import CustomUser, Device, Data, WebhookSubscription
 
 
 class CustomUserSerializer(serializers.ModelSerializer):
@@ -11,10 +11,38 @@ class CustomUserSerializer(serializers.ModelSerializer):
 class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
-        fields = ['id', 'user', 'name', 'location']
+        fields = ['id', 'user', 'name', 'location', 'latitude', 'longitude']
+
+    def validate(self, attrs):
+        latitude = attrs.get('latitude', getattr(self.instance, 'latitude', None))
+        longitude = attrs.get('longitude', getattr(self.instance, 'longitude', None))
+        if (latitude is None) != (longitude is None):
+            raise serializers.ValidationError('Provide both latitude and longitude, or neither')
+        return attrs
 
 
 class DataSerializer(serializers.ModelSerializer):
     class Meta:
         model = Data
         fields = ['id', 'device', 'timestamp', 'data']
+
+
+class DeviceDataSerializer(DataSerializer):
+    # Taken as is: a device token has already proven the device, so skip the lookup
+    device = serializers.IntegerField(source='device_id')
+
+
+class WebhookSubscriptionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WebhookSubscription
+        fields = ['id', 'url', 'events', 'max_concurrency', 'is_active']
+
+    def validate_events(self, value):
+        if not isinstance(value, list) or any(event not in WebhookSubscription.EVENT_TYPES for event in value):
+            raise serializers.ValidationError(f'events must be a list of {", ".join(WebhookSubscription.EVENT_TYPES)}')
+        return value
+
+    def validate_max_concurrency(self, value):
+        if not 1 <= value <= 16:
+            raise serializers.ValidationError('max_concurrency must be between 1 and 16')
+        return value
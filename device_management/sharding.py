@@ -0,0 +1,106 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Each shard allocates Device and Data ids from its own block, so the shard
+# of a device can be told from its id alone (see configure_shards).
+SHARD_ID_BLOCK = 2 ** 40
+
+SHARDED_MODELS = {'device', 'data'}
+
+_current_shard = ContextVar('current_shard', default=None)
+
+
+def get_shards():
+    """
+    Return the aliases of the databases holding devices and their data, in block order.
+    """
+    return getattr(settings, 'SHARDS', [DEFAULT_DB_ALIAS])
+
+
+def shard_for_user(user_id):
+    """
+    Return the shard on which new devices of a user are created.
+    """
+    shards = get_shards()
+    return shards[int(user_id) % len(shards)]
+
+
+def shard_for_device(device_id):
+    """
+    Return the shard holding a device and its data, from the id block it belongs to.
+    """
+    shards = get_shards()
+    return shards[min(int(device_id) // SHARD_ID_BLOCK, len(shards) - 1)]
+
+
+def group_by_shard(device_ids):
+    """
+    Group device ids by the shard holding them.
+
+    Returns:
+        dict: Lists of device ids by shard alias.
+    """
+    groups = defaultdict(list)
+    for device_id in device_ids:
+        groups[shard_for_device(device_id)].append(device_id)
+    return groups
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Route Device and Data queries without an instance to route by to the given shard.
+
+    Needed around serializer validation and saving, which go through the
+    default manager and give the router nothing to pick a shard from.
+    """
+    token = _current_shard.set(alias)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+class ShardRouter:
+    """
+    Route Device and Data to their shard and every other model to the primary.
+
+    Existing instances stay on the database they were loaded from. New
+    devices go to the shard of their owner and new data to the shard of
+    their device. Device.user is not enforced by a database constraint since
+    users live on the primary only.
+    """
+
+    def _is_sharded(self, model):
+        return model._meta.app_label == 'device_management' and model._meta.model_name in SHARDED_MODELS
+
+    def db_for_write(self, model, **hints):
+        if not self._is_sharded(model):
+            return DEFAULT_DB_ALIAS
+
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db and self._is_sharded(type(instance)):
+            return instance._state.db
+        if _current_shard.get():
+            return _current_shard.get()
+        if isinstance(instance, model):
+            if model._meta.model_name == 'device' and instance.user_id is not None:
+                return shard_for_user(instance.user_id)
+            if model._meta.model_name == 'data' and instance.device_id is not None:
+                return shard_for_device(instance.device_id)
+        if instance is not None and model._meta.model_name == 'device' \
+                and instance._meta.label == settings.AUTH_USER_MODEL and instance.pk is not None:
+            # Assigning an owner to a device, or reading the devices of a user
+            return shard_for_user(instance.pk)
+        return None
+
+    db_for_read = db_for_write
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == 'device_management' and obj2._meta.app_label == 'device_management':
+            return True
+        return None
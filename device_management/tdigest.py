@@ -0,0 +1,92 @@
+import math
+
+
+class TDigest:
+    """
+    Merging t-digest for streaming quantile estimates in bounded memory.
+
+    Values are buffered and periodically merged into at most about
+    compression * pi / 2 centroids, sized with the arcsine scale function so
+    that the tails (p95, p99) stay accurate. Memory does not grow with the
+    number of values added.
+    """
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.buffer.append(value)
+        self.total += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.compression * 10:
+            self._compress()
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k):
+        k = min(k, self.compression / 4)
+        return (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + [(value, 1) for value in self.buffer])
+        self.buffer = []
+
+        means = []
+        weights = []
+        cumulative = 0
+        mean, weight = points[0]
+        limit = self.total * self._k_inverse(self._k(0) + 1)
+        for m, w in points[1:]:
+            if cumulative + weight + w <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                cumulative += weight
+                limit = self.total * self._k_inverse(self._k(cumulative / self.total) + 1)
+                mean, weight = m, w
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def quantile(self, q):
+        """
+        Estimate the q-th quantile (0 <= q <= 1) of the values added so far.
+
+        Returns:
+            float: The estimate, or None if no value was added.
+        """
+        self._compress()
+        if not self.total:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+
+        target = q * self.total
+        previous_center, previous_mean = 0, self.min
+        cumulative = 0
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target < center:
+                fraction = (target - previous_center) / (center - previous_center) if center > previous_center else 0
+                return previous_mean + fraction * (mean - previous_mean)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        if self.total > previous_center:
+            fraction = (target - previous_center) / (self.total - previous_center)
+            return previous_mean + fraction * (self.max - previous_mean)
+        return self.max
@@ -0,0 +1,192 @@
+import json
+import os
+import time
+import warnings
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+
+import pytest
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from model_bakery import baker
+from rest_framework.test import APIClient
+
+from device_management.models import CustomUser, Device, Data, WebhookSubscription
+
+# Every endpoint runs against seeded data of each of these sizes and must issue
+# the same number of queries for all of them, at most its declared budget.
+SIZES = [1, 10, 50]
+
+READINGS_PER_DEVICE = 5
+
+# Best timing of every endpoint so far. Timings only compare on the same hardware, so
+# the file is not committed: CI keeps it between runs (e.g. as a build cache restored
+# to ENDPOINT_TIMINGS_FILE) and runs with CHECK_TIMINGS=1 once a baseline exists.
+TIMINGS_FILE = os.environ.get('ENDPOINT_TIMINGS_FILE', str(settings.BASE_DIR / '.endpoint_timings.json'))
+
+# With CHECK_TIMINGS=1, fail when an endpoint gets this much slower than its recorded baseline
+TIMING_TOLERANCE = 5
+
+TIMING_SLACK = 0.05
+
+RANGE = {'start': '2024-01-01T00:00:00Z', 'end': '2024-01-02T00:00:00Z'}
+
+Case = namedtuple('Case', 'name method role budget prepare postgres_only', defaults=[False])
+
+
+class Seed:
+    """
+    Users of every role and a growing fleet of devices with readings.
+    """
+
+    def __init__(self):
+        self.users = {role: baker.make(CustomUser, role=role, username=f'seed_{role}')
+                      for role in ['LO', 'LE', 'LM', 'OW']}
+        for user in self.users.values():
+            user.set_password('password123')
+            user.save()
+        self.devices = []
+
+    def grow(self, size):
+        while len(self.devices) < size:
+            for user in self.users.values():
+                self.add_device(user)
+            baker.make(CustomUser, username=f'extra_{len(self.devices)}')
+
+    def add_device(self, user):
+        device = baker.make(Device, user=user, name='Device', location='Location',
+                            latitude=52.5 + len(self.devices) / 1000, longitude=13.4)
+        for i in range(READINGS_PER_DEVICE):
+            baker.make(Data, device=device, timestamp=f'2024-01-01T0{i}:00:00Z', data={'temperature': 20 + i})
+        if user.role == 'OW':
+            self.devices.append(device)
+        return device
+
+    def device_ids(self):
+        return ','.join(str(device.id) for device in self.devices)
+
+
+def new_user():
+    return baker.make(CustomUser, role='LO')
+
+
+def new_webhook(seed):
+    return baker.make(WebhookSubscription, user=seed.users['OW'], url='http://127.0.0.1/')
+
+
+CASES = [
+    Case('register_user', 'post', None, 7, lambda seed: (
+        {}, {'username': f'new_{time.monotonic_ns()}', 'password': 'password123'})),
+    Case('login', 'post', None, 5, lambda seed: ({}, {'username': 'seed_OW', 'password': 'password123'})),
+    Case('get_all_users', 'get', 'OW', 1, lambda seed: ({}, {})),
+    Case('get_user', 'get', 'LM', 1, lambda seed: ({'user_id': seed.users['LO'].id}, {})),
+    Case('manage_user_roles', 'put', 'OW', 4, lambda seed: (
+        {'user_id': new_user().id}, {'username': f'role_{time.monotonic_ns()}', 'password': 'x', 'role': 'LE'})),
+    Case('delete_user', 'delete', 'OW', 14, lambda seed: ({'user_id': seed.add_device(new_user()).user_id}, {})),
+    Case('get_devices', 'get', 'LO', 1, lambda seed: ({}, {})),
+    Case('get_all_devices', 'get', 'LM', 1, lambda seed: ({}, {})),
+    Case('get_nearby_devices', 'get', 'LM', 2, lambda seed: ({}, {'lat': 52.5, 'lon': 13.4, 'radius': 50, 'latest': 'true'})),
+    Case('add_device', 'post', 'LE', 3, lambda seed: ({}, {'name': 'Device', 'location': 'Location'})),
+    Case('update_device_info', 'put', 'OW', 4, lambda seed: (
+        {'device_id': seed.devices[0].id}, {'name': 'Device', 'location': 'Location', 'user': seed.users['OW'].id})),
+    Case('delete_device', 'delete', 'LM', 5, lambda seed: ({'device_id': seed.add_device(seed.users['OW']).id}, {})),
+    Case('issue_device_token', 'post', 'OW', 3, lambda seed: ({'device_id': seed.devices[0].id}, {})),
+    Case('revoke_device_token', 'delete', 'OW', 3, lambda seed: ({'device_id': seed.devices[0].id}, {})),
+    Case('submit_data', 'post', 'OW', 4, lambda seed: (
+        {}, {'device_id': seed.devices[0].id, 'data': {'temperature': 20}})),
+    Case('get_device_data', 'get', 'LM', 2, lambda seed: ({'device_id': seed.devices[0].id}, RANGE)),
+    Case('get_devices_data', 'get', 'OW', 2, lambda seed: ({}, dict(RANGE, ids=seed.device_ids())), True),
+    Case('get_device_stats', 'get', 'OW', 2, lambda seed: (
+        {'device_id': seed.devices[0].id}, dict(RANGE, key='temperature', mode='approximate'))),
+    Case('get_devices_stats', 'get', 'OW', 2, lambda seed: (
+        {}, dict(RANGE, ids=seed.device_ids(), key='temperature', mode='approximate'))),
+    Case('get_webhooks', 'get', 'OW', 1, lambda seed: ({}, {'created': new_webhook(seed).id})),
+    Case('add_webhook', 'post', 'OW', 2, lambda seed: ({}, {'url': 'http://127.0.0.1/', 'events': ['data.created']})),
+    Case('delete_webhook', 'delete', 'OW', 2, lambda seed: ({'webhook_id': new_webhook(seed).id}, {})),
+    Case('schema-json', 'get', None, 0, lambda seed: ({'format': '.json'}, {})),
+    Case('schema-swagger-ui', 'get', None, 0, lambda seed: ({}, {})),
+    Case('schema-redoc', 'get', None, 0, lambda seed: ({}, {})),
+]
+
+
+@contextmanager
+def capture_queries():
+    """
+    Collect the queries run on every configured database.
+    """
+    queries = []
+    contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+    with ExitStack() as stack:
+        for context in contexts:
+            stack.enter_context(context)
+        yield queries
+    for context in contexts:
+        # Savepoints only come from the transaction wrapping each test
+        queries.extend(query for query in context.captured_queries if 'SAVEPOINT' not in query['sql'])
+
+
+def record_timing(name, size, elapsed):
+    """
+    Record the best timing of an endpoint, failing with CHECK_TIMINGS=1 when it regressed.
+    """
+    timings = {}
+    if os.path.exists(TIMINGS_FILE):
+        with open(TIMINGS_FILE) as f:
+            timings = json.load(f)
+    key = f'{name}[{size}]'
+    baseline = timings.get(key)
+    if baseline is None and os.environ.get('CHECK_TIMINGS') == '1':
+        warnings.warn(f'No timing baseline for {key} in {TIMINGS_FILE}, recording one')
+    if baseline is not None and os.environ.get('CHECK_TIMINGS') == '1':
+        assert elapsed <= baseline * TIMING_TOLERANCE + TIMING_SLACK, \
+            f'{key} took {elapsed:.3f}s, baseline {baseline:.3f}s'
+    timings[key] = min(elapsed, baseline) if baseline is not None else elapsed
+    with open(TIMINGS_FILE, 'w') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+
+def test_every_endpoint_has_a_budget():
+    names = {pattern.name for pattern in get_resolver().url_patterns if pattern.name}
+    missing = names - {case.name for case in CASES}
+    assert not missing, f'No query budget declared for {sorted(missing)}'
+
+
+@pytest.mark.django_db(databases='__all__')
+@pytest.mark.parametrize('case', CASES, ids=lambda case: case.name)
+def test_query_budget(case, settings):
+    if case.name not in {pattern.name for pattern in get_resolver().url_patterns}:
+        pytest.skip(f'{case.name} is not mounted')
+    if case.postgres_only and connection.vendor != 'postgresql':
+        pytest.skip('needs PostgreSQL')
+    settings.RATE_LIMITS = {}
+
+    seed = Seed()
+    counts = {}
+    for size in SIZES:
+        seed.grow(size)
+        kwargs, data = case.prepare(seed)
+        client = APIClient()
+        if case.role:
+            client.force_authenticate(user=seed.users[case.role])
+        url = reverse(case.name, kwargs=kwargs)
+        cache.clear()
+
+        with capture_queries() as queries:
+            started = time.perf_counter()
+            if case.method == 'get':
+                response = client.get(url, data)
+            else:
+                response = getattr(client, case.method)(url, data, format='json')
+            elapsed = time.perf_counter() - started
+
+        assert response.status_code < 400, f'{case.name} returned {response.status_code}'
+        counts[size] = len(queries)
+        record_timing(case.name, size, elapsed)
+
+    assert len(set(counts.values())) == 1, f'{case.name} query count grows with the data: {counts}'
+    assert counts[SIZES[0]] <= case.budget, \
+        f'{case.name} ran {counts[SIZES[0]]} queries, budget is {case.budget}:\n' + \
+        '\n'.join(query['sql'] for query in queries)
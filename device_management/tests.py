@@ -1,9 +1,10 @@
 import pytest
+from django.core.cache import cache
 from django.test import Client
 from model_bakery import baker
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
-from device_management.models import CustomUser, Device
+from device_management.models import CustomUser, Device, Data
 from device_management.views import register_user, login_user, get_devices, submit_data, add_device, update_device, delete_device, get_all_devices, get_user, update_device, get_all_users, manage_user_roles
 import os
 from django.conf import settings
@@ -17,6 +18,14 @@ if not settings.configured:
 # Your test code follows here
 # ...
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    from device_management import device_tokens
+    cache.clear()
+    # Rolled back ids get reused, so revocations must not outlive a test
+    device_tokens._revoked.clear()
+    device_tokens._refreshed[:] = [None, 0]
+
 @pytest.fixture
 def api_client():
     return APIClient()
@@ -90,4 +99,483 @@ def test_delete_device(api_client, user, device):
     assert response.status_code == 200
     assert 'message' in response.data
     assert response.data['message'] == 'Device deleted successfully'
-    assert 'result' in response.data
\ No newline at end of file
+    assert 'result' in response.data
+
+def test_submit_data_rate_limited(api_client, user, device, settings):
+    settings.RATE_LIMITS = {'user': {}, 'device': {'LO': '2/min'}}
+    api_client.force_authenticate(user=user)
+    for _ in range(2):
+        response = api_client.post(f'{BASE_URL}/devices/add/data/', {'device_id': device.id, 'data': 'Test data'})
+        assert response.status_code != 429
+    response = api_client.post(f'{BASE_URL}/devices/add/data/', {'device_id': device.id, 'data': 'Test data'})
+    assert response.status_code == 429
+    assert int(response['Retry-After']) > 0
+    # Spellings of the same id share the bucket
+    response = api_client.post(f'{BASE_URL}/devices/add/data/', {'device_id': f'0{device.id}', 'data': 'Test data'})
+    assert response.status_code == 429
+
+
+def test_import_data_split_file(tmp_path):
+    from device_management.management.commands.import_data import split_file
+    path = tmp_path / 'data.jsonl'
+    path.write_text(''.join(f'{{"device_id": 1, "data": {{"i": {i}}}}}\n' for i in range(100)))
+    chunks = split_file(str(path), 256)
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == path.stat().st_size
+    content = path.read_bytes()
+    for start, end in chunks:
+        assert content[start:end].endswith(b'\n')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_data_command(user, device, tmp_path):
+    from django.core.management import call_command
+    path = tmp_path / 'data.jsonl'
+    lines = [f'{{"device_id": {device.id}, "timestamp": "2024-01-01T00:0{i}:00Z", "data": {{"i": {i}}}}}'
+             for i in range(6)]
+    lines[2] = f'{{"device_id": {device.id + 1}, "data": {{"i": 2}}}}'
+    lines[4] = '{"device_id":'
+    # A raw U+2028 is valid inside a JSON string and does not end the line
+    lines[5] = f'{{"device_id": {device.id}, "timestamp": "2024-01-01T00:05:00Z", "data": {{"i": 5, "note": "a\u2028b"}}}}'
+    # jsonb has no NUL character, one would abort the whole COPY
+    lines.append(f'{{"device_id": {device.id}, "data": {{"note": "a\\u0000b"}}}}')
+    path.write_text('\n'.join(lines) + '\n')
+    # One chunk per line, the first one already imported by an earlier run
+    checkpoint = tmp_path / 'data.jsonl.checkpoint'
+    checkpoint.write_text('{"chunk_size": 1, "completed": [0]}')
+    rejects = tmp_path / 'rejects.txt'
+
+    call_command('import_data', str(path), '--chunk-size', '1', '--workers', '2', '--rejects', str(rejects))
+    assert sorted(Data.objects.values_list('data__i', flat=True)) == [1, 3, 5]
+    reasons = sorted(line.split('\t')[1] for line in rejects.read_text().splitlines())
+    assert reasons == ['invalid JSON', 'invalid JSON', f'unknown device {device.id + 1}']
+
+    # Every chunk is checkpointed now, a rerun loads nothing twice
+    call_command('import_data', str(path), '--chunk-size', '1', '--workers', '2')
+    assert Data.objects.count() == 3
+
+
+def test_get_device_data(api_client, user, device):
+    baker.make(Data, device=device, timestamp='2024-01-01T00:00:00Z', data={'temperature': 20})
+    baker.make(Data, device=device, timestamp='2024-01-02T00:00:00Z', data={'temperature': 21})
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/',
+                              {'start': '2024-01-01T00:00:00Z', 'end': '2024-01-01T12:00:00Z'})
+    assert response.status_code == 200
+    assert len(response.data) == 1
+    assert response.data[0]['data'] == {'temperature': 20}
+
+    # Bounds without an offset are UTC, alone or mixed with offset ones
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/',
+                              {'start': '2024-01-01T00:00:00Z', 'end': '2024-01-01T12:00:00'})
+    assert response.status_code == 200
+    assert len(response.data) == 1
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/',
+                              {'start': '2024-01-01T00:00:00', 'end': '2024-01-02T00:00:00', 'step': '3600'})
+    assert response.status_code != 500
+
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/',
+                              {'start': '2024-01-01T00:00:00Z', 'end': '2024-01-02T00:00:00Z', 'step': '1'})
+    assert response.status_code == 400
+
+
+def test_get_device_data_payload_filters(api_client, user, device):
+    baker.make(Data, device=device, timestamp='2024-01-01T00:00:00Z', data={'temperature': 20})
+    baker.make(Data, device=device, timestamp='2024-01-01T01:00:00Z', data={'temperature': 90, 'status': 'fault'})
+    api_client.force_authenticate(user=user)
+    params = {'start': '2024-01-01T00:00:00Z', 'end': '2024-01-02T00:00:00Z'}
+
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/', dict(params, has_key='status'))
+    assert response.status_code == 200
+    assert [reading['data']['temperature'] for reading in response.data] == [90]
+
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/stats/',
+                              dict(params, has_key='status', key='temperature', mode='approximate'))
+    assert response.data['stats'][device.id]['count'] == 1
+
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/data/', dict(params, contains='["status"]'))
+    assert response.status_code == 400
+
+
+def test_get_devices_data_checks_ownership(api_client, user, device):
+    other = baker.make(Device, name='Device 2', location='Location 2')
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/devices/data/', {
+        'ids': f'{device.id},{other.id}', 'start': '2024-01-01T00:00:00Z', 'end': '2024-01-02T00:00:00Z',
+    })
+    assert response.status_code == 404
+    assert str(other.id) in response.data['error']
+
+
+def test_get_device_stats_approximate(api_client, user, device):
+    for value in range(1, 101):
+        baker.make(Data, device=device, timestamp='2024-01-01T00:00:00Z', data={'temperature': value})
+    baker.make(Data, device=device, timestamp='2024-01-01T00:00:00Z', data={'status': 'fault'})
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/devices/{device.id}/stats/', {
+        'start': '2024-01-01T00:00:00Z', 'end': '2024-01-02T00:00:00Z', 'key': 'temperature', 'mode': 'approximate',
+    })
+    assert response.status_code == 200
+    stats = response.data['stats'][device.id]
+    assert stats['count'] == 100
+    assert stats['min'] == 1
+    assert stats['max'] == 100
+    assert stats['mean'] == 50.5
+    assert abs(stats['p50'] - 50.5) < 1
+
+
+def test_get_devices_conditional_get(api_client, user, device):
+    user.role = 'LE'
+    user.save()
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/devices/')
+    assert response.status_code == 200
+    etag = response['ETag']
+
+    response = api_client.get(f'{BASE_URL}/devices/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+    api_client.post(f'{BASE_URL}/devices/add/', {'name': 'Device 2', 'location': 'Location 2'}, format='json')
+    response = api_client.get(f'{BASE_URL}/devices/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+    assert len(response.data) == 2
+
+
+def test_get_all_users_fast_path(api_client, user):
+    user.role = 'OW'
+    user.save()
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/users/all/')
+    assert response.status_code == 200
+    assert response.json() == [{'id': user.id, 'username': 'john', 'email': user.email, 'role': 'OW'}]
+
+
+def test_get_all_devices_fast_path(api_client, user, device):
+    user.role = 'LM'
+    user.save()
+    api_client.force_authenticate(user=user)
+    response = api_client.get(f'{BASE_URL}/devices/all/')
+    assert response.status_code == 200
+    assert response.json() == [{'id': device.id, 'user': user.id, 'name': 'Device 1', 'location': 'Location 1',
+                                'latitude': None, 'longitude': None}]
+    assert api_client.get(f'{BASE_URL}/devices/all/', {'limit': -1}).status_code == 400
+    assert api_client.get(f'{BASE_URL}/devices/all/', {'after': -1}).status_code == 400
+
+
+def test_get_nearby_devices(api_client, user):
+    berlin = baker.make(Device, user=user, name='Berlin', location='Berlin', latitude=52.52, longitude=13.405)
+    potsdam = baker.make(Device, user=user, name='Potsdam', location='Potsdam', latitude=52.39, longitude=13.065)
+    baker.make(Device, user=user, name='Paris', location='Paris', latitude=48.857, longitude=2.352)
+    baker.make(Data, device=berlin, timestamp='2024-01-01T00:00:00Z', data={'temperature': 20})
+    baker.make(Data, device=berlin, timestamp='2024-01-02T00:00:00Z', data={'temperature': 21})
+    api_client.force_authenticate(user=user)
+
+    response = api_client.get(f'{BASE_URL}/devices/nearby/', {'lat': 52.5, 'lon': 13.4, 'radius': 30, 'latest': 'true'})
+    assert response.status_code == 200
+    assert [row['id'] for row in response.data] == [berlin.id, potsdam.id]
+    assert response.data[0]['distance_km'] < 5
+    assert response.data[0]['latest']['data'] == {'temperature': 21}
+    assert response.data[1]['latest'] is None
+
+    response = api_client.get(f'{BASE_URL}/devices/nearby/', {'lat': 52.5, 'lon': 13.4, 'radius': 30, 'limit': 1})
+    assert [row['id'] for row in response.data] == [berlin.id]
+    response = api_client.get(f'{BASE_URL}/devices/nearby/', {'lat': 52.5, 'lon': 13.4, 'radius': 5000})
+    assert response.status_code == 400
+
+    response = api_client.get(f'{BASE_URL}/devices/nearby/',
+                              {'min_lat': 40, 'min_lon': 0, 'max_lat': 50, 'max_lon': 10})
+    assert [row['name'] for row in response.data] == ['Paris']
+
+    response = api_client.get(f'{BASE_URL}/devices/nearby/', {'lat': 52.5, 'lon': 13.4})
+    assert response.status_code == 400
+
+
+def test_submit_data_with_device_token(api_client, user, device):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from device_management.device_tokens import refresh_revocations
+    other = baker.make(Device, user=user, name='Device 2', location='Location 2')
+    # Only users who may submit data for the device can issue its token
+    user.role = 'LE'
+    user.save()
+    api_client.force_authenticate(user=user)
+    response = api_client.post(f'{BASE_URL}/devices/{device.id}/token/')
+    assert response.status_code == 403
+    manager = baker.make(CustomUser, role='LM')
+    manager_client = APIClient()
+    manager_client.force_authenticate(user=manager)
+    response = manager_client.post(f'{BASE_URL}/devices/{device.id}/token/')
+    assert response.status_code == 404
+
+    user.role = 'OW'
+    user.save()
+    response = api_client.post(f'{BASE_URL}/devices/{device.id}/token/')
+    assert response.status_code == 201
+    token = response.data['token']
+
+    device_client = APIClient()
+    device_client.credentials(HTTP_AUTHORIZATION=f'Device {token}')
+    refresh_revocations(force=True)
+    with CaptureQueriesContext(connection) as queries:
+        response = device_client.post(f'{BASE_URL}/devices/add/data/',
+                                      {'device_id': device.id, 'data': {'temperature': 20}}, format='json')
+    assert response.status_code == 201
+    # Authentication and authorization need no query, only the reading and its outbox event are inserted
+    assert [query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']] == ['INSERT', 'INSERT']
+    assert Data.objects.filter(device=device).count() == 1
+
+    response = device_client.post(f'{BASE_URL}/devices/add/data/',
+                                  {'device_id': other.id, 'data': {'temperature': 20}}, format='json')
+    assert response.status_code == 401
+
+    api_client.delete(f'{BASE_URL}/devices/{device.id}/token/revoke/')
+    response = device_client.post(f'{BASE_URL}/devices/add/data/',
+                                  {'device_id': device.id, 'data': {'temperature': 20}}, format='json')
+    assert response.status_code == 401
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submit_data_with_token_of_deleted_device(api_client, user, device):
+    from device_management.device_tokens import make_token
+    api_client.credentials(HTTP_AUTHORIZATION=f'Device {make_token(device)}')
+    # Deleted by another process, whose revocation this one has not loaded yet
+    Device.objects.filter(id=device.id).delete()
+    response = api_client.post(f'{BASE_URL}/devices/add/data/',
+                               {'device_id': device.id, 'data': {'temperature': 20}}, format='json')
+    assert response.status_code == 404
+
+
+def test_mqtt_ingest_worker(user, device):
+    import json
+    from rest_framework_simplejwt.tokens import RefreshToken
+    from device_management.device_tokens import make_token
+    from device_management.ingest import BatchWriter, IngestWorker, QueueClient
+    other = baker.make(Device, name='Device 2', location='Location 2')
+    user.role = 'OW'
+    user.save()
+
+    client = QueueClient()
+    writer = BatchWriter(batch_size=2, flush_interval=60)
+    worker = IngestWorker(client, 'devices/+/data', writer=writer)
+    token = make_token(device)
+    client.publish(f'devices/{device.id}/data', json.dumps({'token': token, 'data': {'temperature': 20}}))
+    client.publish(f'devices/{device.id}/data', json.dumps({
+        'token': str(RefreshToken.for_user(user).access_token), 'data': {'temperature': 21},
+        'timestamp': '2024-01-01T00:00:00Z',
+    }))
+    client.publish(f'devices/{device.id}/data', json.dumps({'token': token, 'data': {'temperature': 22}}))
+    client.publish(f'devices/{other.id}/data', json.dumps({'token': token, 'data': {'temperature': 23}}))
+    client.publish(f'devices/{device.id}/data', 'not json')
+    client.publish(f'devices/{device.id}/data', '{"token": "%s", "data": {"temperature": NaN}}' % token)
+    client.publish(f'devices/{device.id}/data', '{"token": "%s", "data": {"note": "a\\u0000b"}}' % token)
+    worker.run(client.messages.empty)
+
+    assert sorted(Data.objects.values_list('data__temperature', flat=True)) == [20, 21, 22]
+    assert worker.received == 7
+    assert worker.rejects['not authorized'] == 1
+    assert worker.rejects['out of range float value'] == 1
+    assert worker.rejects['NUL character in string'] == 1
+    assert sum(worker.rejects.values()) == 4
+
+
+def test_mqtt_ingest_retries_failed_writes(user, device, monkeypatch):
+    from django.db import OperationalError
+    from django.utils import timezone
+    from device_management import ingest
+    now = [0.0]
+    writer = ingest.BatchWriter(batch_size=1, flush_interval=5, clock=lambda: now[0])
+    copy_rows = ingest.copy_rows
+
+    def lose_connection(rows, shard):
+        monkeypatch.setattr(ingest, 'copy_rows', copy_rows)
+        raise OperationalError('server closed the connection unexpectedly')
+
+    monkeypatch.setattr(ingest, 'copy_rows', lose_connection)
+    writer.add((device.id, timezone.now(), {'temperature': 20}))
+    # The batch is kept for a retry instead of being lost
+    assert writer.retries == 1 and len(writer.rows) == 1
+    writer.add((device.id, timezone.now(), {'temperature': 21}))
+    assert not writer.due() and Data.objects.count() == 0
+
+    now[0] = 5
+    assert writer.due()
+    writer.flush()
+    assert writer.written == 2 and Data.objects.count() == 2
+
+
+def test_profiling_middleware(api_client, user, device, settings, tmp_path):
+    from io import StringIO
+    from django.core.management import call_command
+    settings.PROFILING_TOKEN = 'secret'
+    settings.PROFILING_DIR = tmp_path
+    user.role = 'LM'
+    user.save()
+    api_client.force_authenticate(user=user)
+
+    # Profiled first: later requests are answered from the response cache
+    response = api_client.get(f'{BASE_URL}/devices/all/', HTTP_X_PROFILE='secret')
+    assert response['X-Profile-Id'].startswith('get_all_devices/')
+    response = api_client.get(f'{BASE_URL}/devices/all/')
+    assert 'X-Profile-Id' not in response
+    response = api_client.get(f'{BASE_URL}/devices/all/', HTTP_X_PROFILE='wrong')
+    assert 'X-Profile-Id' not in response
+    assert len(list((tmp_path / 'get_all_devices').glob('*.prof'))) == 1
+
+    out = StringIO()
+    call_command('profile_report', dir=str(tmp_path), stdout=out)
+    assert 'get_all_devices: 1 profiled requests' in out.getvalue()
+    assert 'SELECT' in out.getvalue()
+
+
+def test_webhook_dispatch(api_client, user, device):
+    import hashlib
+    import hmac
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from device_management.webhooks import Dispatcher
+
+    received = []
+    statuses = [500, 200, 200]
+
+    class Endpoint(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((body, self.headers['X-Webhook-Signature']))
+            self.send_response(statuses.pop(0))
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Endpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        user.role = 'OW'
+        user.save()
+        api_client.force_authenticate(user=user)
+        response = api_client.post(f'{BASE_URL}/webhooks/add/', {
+            'url': f'http://127.0.0.1:{server.server_port}/', 'events': ['data.created', 'device.created'],
+        }, format='json')
+        assert response.status_code == 201
+        secret = response.data['secret']
+
+        for value in [20, 21]:
+            api_client.post(f'{BASE_URL}/devices/add/data/', {'device_id': device.id, 'data': {'temperature': value}},
+                            format='json')
+        api_client.put(f'{BASE_URL}/users/{user.id}/roles/', {'username': 'john', 'password': 'x', 'role': 'OW'},
+                       format='json')
+
+        dispatcher = Dispatcher(backoff=0)
+        assert dispatcher.run_once() == 0
+        assert dispatcher.run_once() == 2
+        assert dispatcher.run_once() == 0
+    finally:
+        server.shutdown()
+
+    body, signature = received[-1]
+    assert signature == 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    events = json.loads(body)['events']
+    assert [event['data']['data']['temperature'] for event in events] == [20, 21]
+    assert len(received) == 2
+    assert dispatcher.prune() == 3
+
+
+def test_webhook_dispatch_waits_for_running_transactions(user):
+    import json
+    from device_management.models import OutboxEvent, WebhookSubscription
+    from device_management.webhooks import Dispatcher
+    delivered = []
+
+    class Response:
+        status = 200
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    def opener(request, timeout):
+        delivered.extend(event['data']['n'] for event in json.loads(request.data)['events'])
+        return Response()
+
+    # Transaction 11 got id 2 and committed while transaction 10, which got id 1, is still running
+    horizon = [10]
+    baker.make(WebhookSubscription, user=user, url='http://127.0.0.1/', cursors={'default': [0, 0]})
+    late = OutboxEvent(id=1, type='data.created', payload={'n': 1}, txid=10)
+    OutboxEvent.objects.create(id=2, type='data.created', payload={'n': 2}, txid=11)
+    dispatcher = Dispatcher(opener=opener, horizon=lambda alias: horizon[0])
+    assert dispatcher.run_once() == 0
+    assert dispatcher.prune() == 0
+
+    late.save()
+    horizon[0] = 12
+    assert dispatcher.run_once() == 2
+    assert delivered == [1, 2]
+    assert dispatcher.prune() == 2
+
+
+def test_webhook_dispatch_survives_malformed_responses(user):
+    import http.client
+    from device_management.models import OutboxEvent, WebhookSubscription
+    from device_management.webhooks import Dispatcher
+
+    class Response:
+        status = 200
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    def opener(request, timeout):
+        if request.full_url == 'http://127.0.0.1/broken/':
+            raise http.client.BadStatusLine('garbage')
+        return Response()
+
+    broken = baker.make(WebhookSubscription, user=user, url='http://127.0.0.1/broken/', cursors={'default': [0, 0]})
+    working = baker.make(WebhookSubscription, user=user, url='http://127.0.0.1/', cursors={'default': [0, 0]})
+    OutboxEvent.objects.create(type='data.created', payload={'n': 1}, txid=10)
+    dispatcher = Dispatcher(opener=opener, backoff=0, horizon=lambda alias: 11)
+    assert dispatcher.run_once() == 1
+
+    broken.refresh_from_db()
+    working.refresh_from_db()
+    assert broken.cursors['default'] == [0, 0]
+    assert broken.failures == 1
+    assert working.cursors['default'][0] == 10
+
+
+def test_shard_routing(settings):
+    from device_management.sharding import SHARD_ID_BLOCK, ShardRouter, shard_for_device, shard_for_user
+    settings.SHARDS = ['default', 'shard1']
+    assert shard_for_user(3) == 'shard1'
+    assert shard_for_device(5) == 'default'
+    assert shard_for_device(SHARD_ID_BLOCK + 5) == 'shard1'
+
+    router = ShardRouter()
+    assert router.db_for_write(Device, instance=Device(user_id=3)) == 'shard1'
+    assert router.db_for_write(Data, instance=Data(device_id=SHARD_ID_BLOCK + 5)) == 'shard1'
+    assert router.db_for_read(CustomUser) == 'default'
+
+
+def test_replica_for_pins_recent_writers(settings, user):
+    import time
+    from django.test import RequestFactory
+    from device_management import replicas
+    settings.DATABASE_REPLICAS = {'default': ['replica']}
+    replicas._health['replica'] = (time.monotonic(), True)
+    request = RequestFactory().get(f'{BASE_URL}/devices/')
+    request.user = user
+
+    assert replicas.replica_for('default') == 'default'
+    with replicas.read_only_request(request):
+        assert replicas.replica_for('default') == 'replica'
+        with replicas.primary_reads():
+            assert replicas.replica_for('default') == 'default'
+    replicas.mark_write(user.pk)
+    with replicas.read_only_request(request):
+        assert replicas.replica_for('default') == 'default'
@@ -0,0 +1,111 @@
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """
+    Parse a rate string such as '120/min' into a token bucket.
+
+    Args:
+        rate (str): Number of requests per period ('s', 'min', 'hour' or 'day').
+
+    Returns:
+        tuple: The bucket capacity and the refill rate in tokens per second,
+               or None if the rate is disabled.
+    """
+    if rate is None:
+        return None
+    num, period = rate.split('/')
+    capacity = int(num)
+    return capacity, capacity / DURATIONS[period[0]]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket throttle backed by the Django cache framework.
+
+    Each bucket is stored under a single cache key as a (tokens, last_refill)
+    pair, so a check is one cache read and one cache write with no database
+    query. Limits are looked up per role in settings.RATE_LIMITS[scope].
+    Subclasses provide the bucket identity through get_ident().
+
+    The read and the write are not atomic: concurrent requests on the same
+    bucket can all see the same token count, so workers racing on a bucket
+    may let a few requests over the limit. The limit is meant to shed
+    sustained load, not to be exact.
+    """
+    scope = None
+    timer = time.time
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+        self.retry_after = None
+
+    def get_ident(self, request, view):
+        raise NotImplementedError('.get_ident() must be overridden')
+
+    def get_rate(self, request):
+        role = getattr(request.user, 'role', None)
+        rates = getattr(settings, 'RATE_LIMITS', {}).get(self.scope, {})
+        return parse_rate(rates.get(role))
+
+    def allow_request(self, request, view):
+        bucket = self.get_rate(request)
+        ident = self.get_ident(request, view)
+        if bucket is None or ident is None:
+            return True
+
+        capacity, refill = bucket
+        key = f'throttle_{self.scope}_{ident}'
+        now = self.timer()
+        tokens, last = self.cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * refill)
+
+        if tokens < 1:
+            self.retry_after = (1 - tokens) / refill
+            return False
+
+        # Expire the key once the bucket would be full again anyway
+        self.cache.set(key, (tokens - 1, now), int(capacity / refill) + 1)
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+class UserRateThrottle(TokenBucketThrottle):
+    """
+    Limits write requests per authenticated user.
+    """
+    scope = 'user'
+
+    def get_ident(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return None
+        return request.user.pk
+
+
+class DeviceRateThrottle(TokenBucketThrottle):
+    """
+    Limits write requests per target device, taken from the URL or the request body.
+
+    The id is normalised to an integer, so that 5, "5" and "05" share the
+    bucket of the device they all reach.
+    """
+    scope = 'device'
+
+    def get_ident(self, request, view):
+        device_id = getattr(view, 'kwargs', {}).get('device_id')
+        if device_id is None and hasattr(request.data, 'get'):
+            device_id = request.data.get('device_id')
+        try:
+            return int(device_id)
+        except (TypeError, ValueError):
+            return None
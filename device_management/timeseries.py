@@ -0,0 +1,428 @@
+import json
+import math
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connections
+from django.db.models import BooleanField, OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.fields.json import KeyTransform
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_duration
+
+from .models import Data
+from .replicas import replica_for
+from .sharding import group_by_shard
+from .tdigest import TDigest
+
+FILL_FUNCTIONS = {
+    'none': '{}',
+    'locf': 'locf({})',
+    'interpolate': 'interpolate({})',
+}
+
+MAX_BUCKETS = 10000
+
+MAX_DEVICES = 500
+
+# Default origin of TimescaleDB time_bucket for timestamptz
+ORIGIN = datetime(2000, 1, 3, tzinfo=dt_timezone.utc)
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# Numeric value of a top-level key of Data.data, NULL when missing or not a number
+NUMERIC_VALUE = "CASE WHEN jsonb_typeof(data -> %s) = 'number' THEN (data ->> %s)::double precision END"
+
+
+def parse_range(params):
+    """
+    Parse the start and end of a time range from query parameters.
+
+    Bounds without a UTC offset are taken as UTC.
+
+    Args:
+        params (QueryDict): The request query parameters.
+
+    Returns:
+        tuple: The (start, end) datetimes.
+
+    Raises:
+        ValueError: If a bound is missing, malformed or the range is empty.
+    """
+    start = parse_datetime(params.get('start', ''))
+    end = parse_datetime(params.get('end', ''))
+    if start is None or end is None:
+        raise ValueError('Please provide start and end as ISO 8601 datetimes')
+    start, end = (timezone.make_aware(bound, dt_timezone.utc) if timezone.is_naive(bound) else bound
+                  for bound in (start, end))
+    if start >= end:
+        raise ValueError('start must be before end')
+    return start, end
+
+
+def parse_step(params, start, end):
+    """
+    Parse the bucket width from query parameters.
+
+    Args:
+        params (QueryDict): The request query parameters.
+        start (datetime): Start of the range.
+        end (datetime): End of the range.
+
+    Returns:
+        timedelta: The bucket width.
+
+    Raises:
+        ValueError: If the step is malformed or produces too many buckets.
+    """
+    step = parse_duration(params.get('step', ''))
+    if step is None or step.total_seconds() <= 0:
+        raise ValueError('Please provide step as seconds or a duration such as 00:05:00')
+    if (end - start) / step > MAX_BUCKETS:
+        raise ValueError(f'Range and step produce more than {MAX_BUCKETS} buckets')
+    return step
+
+
+def parse_ids(params):
+    """
+    Parse a comma separated list of device ids from query parameters.
+
+    Args:
+        params (QueryDict): The request query parameters.
+
+    Returns:
+        list: The distinct device ids, in request order.
+
+    Raises:
+        ValueError: If the list is missing, malformed or too long.
+    """
+    try:
+        ids = list(dict.fromkeys(int(i) for i in params.get('ids', '').split(',') if i.strip()))
+    except ValueError:
+        raise ValueError('ids must be a comma separated list of device ids')
+    if not ids:
+        raise ValueError('Please provide the device ids')
+    if len(ids) > MAX_DEVICES:
+        raise ValueError(f'At most {MAX_DEVICES} devices can be requested at once')
+    return ids
+
+
+def parse_payload_filter(params):
+    """
+    Parse the filters on the payload of readings from query parameters.
+
+    contains is a JSON object the payload must contain, e.g.
+    {"status": "fault"}; has_key, which may be repeated, names a top-level key
+    the payload must have.
+
+    Args:
+        params (QueryDict): The request query parameters.
+
+    Returns:
+        dict: The contains object (or None) and the list of required keys.
+
+    Raises:
+        ValueError: If contains is not a JSON object.
+    """
+    contains = params.get('contains')
+    if contains is not None:
+        try:
+            contains = json.loads(contains)
+        except ValueError:
+            contains = None
+        if not isinstance(contains, dict):
+            raise ValueError('contains must be a JSON object')
+    return {'contains': contains, 'keys': [key for key in params.getlist('has_key') if key]}
+
+
+def key_path(key):
+    """
+    Return the jsonpath of a top-level key; JSON string escapes are valid in jsonpath string literals.
+    """
+    return '$.' + json.dumps(key)
+
+
+def payload_sql(payload):
+    """
+    Build the SQL conditions of a payload filter.
+
+    Both filters are operators the GIN jsonb_path_ops index on data answers
+    within the chunks of the time range: containment as @>, and key
+    existence as the jsonpath check @? '$."key"', since that index cannot
+    serve the ? operator.
+
+    Returns:
+        tuple: The conditions, each prefixed with AND, and their parameters.
+    """
+    if not payload:
+        return '', []
+    sql = ''
+    params = []
+    if payload['contains'] is not None:
+        sql += ' AND data @> %s::jsonb'
+        params.append(json.dumps(payload['contains']))
+    for key in payload['keys']:
+        sql += ' AND data @? %s::jsonpath'
+        params.append(key_path(key))
+    return sql, params
+
+
+def filter_payload(readings, payload):
+    """
+    Apply a payload filter to a Data queryset with the same operators as payload_sql().
+
+    Other databases than PostgreSQL get the portable has_keys lookup.
+    """
+    if not payload:
+        return readings
+    if payload['contains'] is not None:
+        readings = readings.filter(data__contains=payload['contains'])
+    if payload['keys'] and connections[readings.db].vendor != 'postgresql':
+        return readings.filter(data__has_keys=payload['keys'])
+    for key in payload['keys']:
+        readings = readings.filter(RawSQL(f'{Data._meta.db_table}.data @? %s::jsonpath', [key_path(key)],
+                                          output_field=BooleanField()))
+    return readings
+
+
+def gapfill_series(device_id, key, start, end, step, fill='none', payload=None):
+    """
+    Compute an evenly spaced series of a numeric key of Data.data.
+
+    Each bucket holds the average of the readings that fall in it. Empty
+    buckets are filled by TimescaleDB time_bucket_gapfill and, depending on
+    fill, carried forward (locf) or linearly interpolated.
+
+    Args:
+        device_id (int): The device to read.
+        key (str): The key of Data.data to aggregate.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        step (timedelta): The bucket width.
+        fill (str): One of 'none', 'locf' or 'interpolate'.
+        payload (dict): Optional filter on the payload of the readings, see parse_payload_filter.
+
+    Returns:
+        tuple: Lists of bucket timestamps and values.
+    """
+    timestamps, series = batch_gapfill_series([device_id], key, start, end, step, fill, payload)
+    return timestamps, series[device_id]
+
+
+def batch_gapfill_series(device_ids, key, start, end, step, fill='none', payload=None):
+    """
+    Compute evenly spaced series of a numeric key for several devices with one query per shard.
+
+    Since every series covers the same buckets, the bucket timestamps are
+    returned once and shared by all devices.
+
+    Args:
+        device_ids (list): The devices to read.
+        key (str): The key of Data.data to aggregate.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        step (timedelta): The bucket width.
+        fill (str): One of 'none', 'locf' or 'interpolate'.
+        payload (dict): Optional filter on the payload of the readings, see parse_payload_filter.
+
+    Returns:
+        tuple: The list of bucket timestamps and a dict of value lists by device id.
+    """
+    value = FILL_FUNCTIONS[fill].format(f'avg({NUMERIC_VALUE})')
+    condition, condition_params = payload_sql(payload)
+    sql = f"""
+        SELECT device_id, time_bucket_gapfill(%s, timestamp, %s, %s) AS bucket, {value}
+        FROM {Data._meta.db_table}
+        WHERE device_id = ANY(%s) AND timestamp >= %s AND timestamp < %s{condition}
+        GROUP BY device_id, bucket
+        ORDER BY device_id, bucket
+    """
+    rows = []
+    for shard, ids in group_by_shard(device_ids).items():
+        with connections[replica_for(shard)].cursor() as cursor:
+            cursor.execute(sql, [step, start, end, key, key, ids, start, end, *condition_params])
+            rows.extend(cursor.fetchall())
+
+    # Devices without any reading in the range get no rows from gapfill
+    buckets = []
+    bucket = start - (start - ORIGIN) % step
+    while bucket < end:
+        buckets.append(bucket)
+        bucket += step
+    series = {device_id: [None] * len(buckets) for device_id in device_ids}
+    index = {bucket: i for i, bucket in enumerate(buckets)}
+    for device_id, bucket, value in rows:
+        if bucket in index:
+            series[device_id][index[bucket]] = value
+    return buckets, series
+
+
+def batch_readings(device_ids, start, end, payload=None):
+    """
+    Fetch the raw readings of several devices with one query per shard.
+
+    Args:
+        device_ids (list): The devices to read.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        payload (dict): Optional filter on the payload of the readings, see parse_payload_filter.
+
+    Returns:
+        dict: Per device id, a dict with the lists of timestamps and data payloads.
+    """
+    condition, condition_params = payload_sql(payload)
+    sql = f"""
+        SELECT device_id, timestamp, data
+        FROM {Data._meta.db_table}
+        WHERE device_id = ANY(%s) AND timestamp >= %s AND timestamp < %s{condition}
+        ORDER BY device_id, timestamp
+    """
+    series = {device_id: {'timestamps': [], 'data': []} for device_id in device_ids}
+    for shard, ids in group_by_shard(device_ids).items():
+        with connections[replica_for(shard)].cursor() as cursor:
+            cursor.execute(sql, [ids, start, end, *condition_params])
+            for device_id, timestamp, data in cursor.fetchall():
+                series[device_id]['timestamps'].append(timestamp)
+                # Django leaves jsonb undecoded on raw psycopg2 cursors
+                series[device_id]['data'].append(json.loads(data) if isinstance(data, str) else data)
+    return series
+
+
+def latest_readings(device_ids):
+    """
+    Fetch the latest reading of several devices with one query per shard.
+
+    On PostgreSQL each device gets a LATERAL lookup ordered by timestamp DESC
+    with LIMIT 1, which walks the (device_id, timestamp DESC) index from its
+    newest entry and stops at the first row, so the cost does not grow with
+    the history of the devices. Of readings sharing the latest timestamp, any
+    one is returned.
+
+    Args:
+        device_ids (list): The devices to read.
+
+    Returns:
+        dict: Per device id with readings, a dict with the timestamp and data of its latest reading.
+    """
+    sql = f"""
+        SELECT devices.device_id, latest.timestamp, latest.data
+        FROM unnest(%s) AS devices (device_id)
+        CROSS JOIN LATERAL (
+            SELECT timestamp, data
+            FROM {Data._meta.db_table}
+            WHERE device_id = devices.device_id
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) latest
+    """
+    latest = {}
+    for shard, ids in group_by_shard(device_ids).items():
+        alias = replica_for(shard)
+        if connections[alias].vendor != 'postgresql':
+            # Correlated subquery fallback for development databases
+            readings = Data.objects.using(alias)
+            newest = readings.filter(device_id=OuterRef('device_id')).order_by('-timestamp').values('timestamp')[:1]
+            rows = readings.filter(device_id__in=ids, timestamp=Subquery(newest)) \
+                .values_list('device_id', 'timestamp', 'data')
+        else:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(sql, [ids])
+                # Django leaves jsonb undecoded on raw psycopg2 cursors
+                rows = [(device_id, timestamp, json.loads(data) if isinstance(data, str) else data)
+                        for device_id, timestamp, data in cursor.fetchall()]
+        for device_id, timestamp, data in rows:
+            latest.setdefault(device_id, {'timestamp': timestamp, 'data': data})
+    return latest
+
+
+def summary_stats(device_ids, key, start, end, payload=None):
+    """
+    Compute exact summary statistics of a numeric key per device in the database.
+
+    Args:
+        device_ids (list): The devices to read.
+        key (str): The key of Data.data to summarize.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        payload (dict): Optional filter on the payload of the readings, see parse_payload_filter.
+
+    Returns:
+        dict: Per device id, the count, min, max, mean, stddev, p50, p95 and p99.
+    """
+    condition, condition_params = payload_sql(payload)
+    sql = f"""
+        SELECT device_id, count(value), min(value), max(value), avg(value), stddev_samp(value),
+               percentile_cont(%s::double precision[]) WITHIN GROUP (ORDER BY value)
+        FROM (
+            SELECT device_id, {NUMERIC_VALUE} AS value
+            FROM {Data._meta.db_table}
+            WHERE device_id = ANY(%s) AND timestamp >= %s AND timestamp < %s{condition}
+        ) readings
+        WHERE value IS NOT NULL
+        GROUP BY device_id
+    """
+    stats = {device_id: empty_stats() for device_id in device_ids}
+    for shard, ids in group_by_shard(device_ids).items():
+        with connections[replica_for(shard)].cursor() as cursor:
+            cursor.execute(sql, [list(PERCENTILES), key, key, ids, start, end, *condition_params])
+            for device_id, count, minimum, maximum, mean, stddev, percentiles in cursor.fetchall():
+                stats[device_id] = dict(
+                    count=count, min=minimum, max=maximum, mean=mean, stddev=stddev,
+                    **{percentile_name(q): value for q, value in zip(PERCENTILES, percentiles)},
+                )
+    return stats
+
+
+def approximate_summary_stats(device_ids, key, start, end, payload=None, chunk_size=10000):
+    """
+    Compute summary statistics of a numeric key per device in one streaming pass.
+
+    Readings are read through a server-side cursor; count, min, max, mean and
+    stddev are exact (Welford's algorithm) and the percentiles are estimated
+    with a t-digest, so memory stays bounded however large the window is.
+
+    Args:
+        device_ids (list): The devices to read.
+        key (str): The key of Data.data to summarize.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        payload (dict): Optional filter on the payload of the readings, see parse_payload_filter.
+        chunk_size (int): Rows fetched per round trip.
+
+    Returns:
+        dict: Per device id, the count, min, max, mean, stddev, p50, p95 and p99.
+    """
+    accumulators = {device_id: [0, 0.0, 0.0, TDigest()] for device_id in device_ids}
+    for shard, ids in group_by_shard(device_ids).items():
+        readings = Data.objects.using(replica_for(shard)).filter(device_id__in=ids, timestamp__gte=start, timestamp__lt=end)
+        readings = filter_payload(readings, payload) \
+            .annotate(value=KeyTransform(key, 'data')).values_list('device_id', 'value')
+        for device_id, value in readings.iterator(chunk_size=chunk_size):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            accumulator = accumulators[device_id]
+            accumulator[0] += 1
+            delta = value - accumulator[1]
+            accumulator[1] += delta / accumulator[0]
+            accumulator[2] += delta * (value - accumulator[1])
+            accumulator[3].add(value)
+
+    stats = {}
+    for device_id, (count, mean, m2, digest) in accumulators.items():
+        if not count:
+            stats[device_id] = empty_stats()
+            continue
+        stats[device_id] = dict(
+            count=count, min=digest.min, max=digest.max, mean=mean,
+            stddev=math.sqrt(m2 / (count - 1)) if count > 1 else None,
+            **{percentile_name(q): digest.quantile(q) for q in PERCENTILES},
+        )
+    return stats
+
+
+def percentile_name(q):
+    return f'p{round(q * 100)}'
+
+
+def empty_stats():
+    return dict(count=0, min=None, max=None, mean=None, stddev=None,
+                **{percentile_name(q): None for q in PERCENTILES})
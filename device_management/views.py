@@ -1,15 +1,54 @@
+import math
+import secrets
+
 from django.contrib.auth import login
 from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from .models import Device, CustomUser
-from .permissions import IsLO, IsLE, IsLM, IsOW
-from .serializers import DeviceSerializer, DataSerializer, CustomUserSerializer
+from .models import Device, CustomUser, Data, WebhookSubscription
+from .permissions import IsLO, IsLE, IsLM, IsOW, IsDevice, can_submit_data
+from .serializers import (DeviceSerializer, DataSerializer, DeviceDataSerializer, CustomUserSerializer,
+                          WebhookSubscriptionSerializer)
+from .caching import cache_response, bump_version
+from .device_tokens import DeviceIdentity, DeviceTokenAuthentication, revoke, rotate
+from .fastpath import DEVICE_FIELDS, USER_FIELDS, JSONBytesResponse, dumps, encode_rows, row_dicts
+from .geo import CANDIDATE_FACTOR, cover, distance_km, parse_area, parse_limit
+from .replicas import replica_for
+from .sharding import get_shards, group_by_shard, shard_for_device, shard_for_user, use_shard
+from .throttling import UserRateThrottle, DeviceRateThrottle
+from .timeseries import (FILL_FUNCTIONS, parse_range, parse_step, parse_ids, parse_payload_filter, filter_payload,
+                         gapfill_series, batch_gapfill_series, batch_readings, latest_readings, summary_stats,
+                         approximate_summary_stats)
+from .webhooks import current_cursors, emit
+
+
+def readable_devices(user, shard):
+    """
+    Return the devices of a shard a user may read: their own for LO/LE, all for LM/OW.
+    """
+    devices = Device.objects.using(replica_for(shard))
+    if user.role in ['LM', 'OW']:
+        return devices.all()
+    return devices.filter(user_id=user.pk)
+
+
+def unreadable_devices(user, ids):
+    """
+    Return the ids among ids that do not exist or that the user may not read.
+    """
+    found = set()
+    for shard, shard_ids in group_by_shard(ids).items():
+        found.update(readable_devices(user, shard).filter(id__in=shard_ids).values_list('id', flat=True))
+    return [device_id for device_id in ids if device_id not in found]
 
 
 @api_view(['POST'])
@@ -41,6 +80,7 @@ def register_user(request):
         serializer = CustomUserSerializer(data=data)
         if serializer.is_valid():
             user = serializer.save()
+            bump_version('users')
 
             # Generate JWT token
             refresh = RefreshToken.for_user(user)
@@ -145,6 +185,7 @@ GET /users/{user_id}: View basic user profile
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsLO])
+@cache_response('devices')
 def get_devices(request):
     """
     Retrieves a list of devices associated with a specific user.
@@ -171,17 +212,24 @@ def get_devices(request):
             return Response(serializer.data)
         ```
     """
-    devices = Device.objects.filter(user=request.user)
+    devices = [device for shard in get_shards()
+               for device in Device.objects.using(replica_for(shard)).filter(user_id=request.user.pk)]
     serializer = DeviceSerializer(devices, many=True)
     return Response(serializer.data)
 
 
 @api_view(['POST'])
-@permission_classes([IsAuthenticated, IsLO])
+@authentication_classes([DeviceTokenAuthentication, *api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+@permission_classes([IsAuthenticated, IsLO | IsDevice])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
 def submit_data(request):
     """
     Submit data to a device.
 
+    Devices may authenticate with their own token ('Authorization: Device
+    <token>') instead of a user's JWT. The token is only valid for its device
+    and is checked from its signature, with neither a user nor a device query.
+
     Args:
         request (HttpRequest): The HTTP request object.
 
@@ -201,22 +249,291 @@ def submit_data(request):
         if not device_id or not data_value:
             return Response({'error': 'Please provide both device_id and data'}, status=status.HTTP_400_BAD_REQUEST)
 
-        device = Device.objects.filter(id=device_id).first()
-        if not device or (device.user != request.user or device.user.role not in ['LM', 'OW']):
+        shard = shard_for_device(device_id)
+        if isinstance(request.user, DeviceIdentity):
+            authorized = request.user.device_id == int(device_id)
+            serializer_class = DeviceDataSerializer
+        else:
+            device = Device.objects.using(shard).filter(id=device_id).first()
+            # The owner is request.user here, so its role needs no query of its own
+            authorized = device is not None and can_submit_data(request.user, device.user_id)
+            serializer_class = DataSerializer
+        if not authorized:
             return Response({'error': 'You are not authorized to submit data to this device'},
                             status=status.HTTP_401_UNAUTHORIZED)
 
         data['device'] = device_id
-        serializer = DataSerializer(data=data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        with use_shard(shard):
+            serializer = serializer_class(data=data)
+            if serializer.is_valid():
+                try:
+                    with transaction.atomic(using=shard):
+                        serializer.save()
+                        emit('data.created', serializer.data, shard)
+                except IntegrityError:
+                    # Device tokens are not checked against the devices table, the device may be gone
+                    return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
+                return Response(serializer.data, status=status.HTTP_201_CREATED)
+            else:
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    except KeyError:
+    except (KeyError, ValueError):
         return Response({'error': 'Invalid input data'}, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsLO])
+def get_device_data(request, device_id):
+    """
+    Retrieve the readings of a device in a time range.
+
+    Without a step the raw readings are returned. With key and step the
+    readings are resampled in the database into an evenly spaced series of
+    the average of data[key] per bucket, with empty buckets filled according
+    to fill ('none', 'locf' or 'interpolate'). Readings can be restricted to
+    those whose payload contains a JSON object (contains) or has a key
+    (has_key, repeatable).
+
+    Args:
+        request (HttpRequest): The HTTP request object with start, end and optionally key, step, fill, contains and has_key.
+        device_id (int): The ID of the device.
+
+    Returns:
+        Response: The readings, or the bucket timestamps and values of the series.
+    """
+    device = get_object_or_404(readable_devices(request.user, shard_for_device(device_id)), id=device_id)
+    params = request.query_params
+    try:
+        start, end = parse_range(params)
+        payload = parse_payload_filter(params)
+        if 'step' not in params:
+            readings = Data.objects.using(device._state.db).filter(device=device, timestamp__gte=start, timestamp__lt=end)
+            readings = filter_payload(readings, payload).order_by('timestamp')
+            serializer = DataSerializer(readings, many=True)
+            return Response(serializer.data)
+
+        step = parse_step(params, start, end)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    key = params.get('key')
+    fill = params.get('fill', 'none')
+    if not key:
+        return Response({'error': 'Please provide the data key to aggregate'}, status=status.HTTP_400_BAD_REQUEST)
+    if fill not in FILL_FUNCTIONS:
+        return Response({'error': f'fill must be one of {", ".join(FILL_FUNCTIONS)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    timestamps, values = gapfill_series(device.id, key, start, end, step, fill, payload)
+    return Response({
+        'device': device.id,
+        'key': key,
+        'step': step.total_seconds(),
+        'timestamps': timestamps,
+        'values': values,
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsLO])
+def get_devices_data(request):
+    """
+    Retrieve the readings of several devices in a time range with one query.
+
+    Takes the same parameters as get_device_data plus ids, a comma separated
+    list of device ids. LO/LE users may only request their own devices.
+    Series are returned in a columnar layout: with step, the bucket
+    timestamps are shared and each device maps to its list of values;
+    without step, each device maps to its lists of timestamps and payloads.
+
+    Args:
+        request (HttpRequest): The HTTP request object with ids, start, end and optionally key, step, fill, contains and has_key.
+
+    Returns:
+        Response: The series of every requested device, keyed by device id.
+    """
+    params = request.query_params
+    try:
+        ids = parse_ids(params)
+        start, end = parse_range(params)
+        step = parse_step(params, start, end) if 'step' in params else None
+        payload = parse_payload_filter(params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    missing = unreadable_devices(request.user, ids)
+    if missing:
+        return Response({'error': f'Devices not found: {", ".join(map(str, missing))}'},
+                        status=status.HTTP_404_NOT_FOUND)
+
+    if step is None:
+        return Response({'series': batch_readings(ids, start, end, payload)})
+
+    key = params.get('key')
+    fill = params.get('fill', 'none')
+    if not key:
+        return Response({'error': 'Please provide the data key to aggregate'}, status=status.HTTP_400_BAD_REQUEST)
+    if fill not in FILL_FUNCTIONS:
+        return Response({'error': f'fill must be one of {", ".join(FILL_FUNCTIONS)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    timestamps, series = batch_gapfill_series(ids, key, start, end, step, fill, payload)
+    return Response({
+        'key': key,
+        'step': step.total_seconds(),
+        'timestamps': timestamps,
+        'series': series,
+    })
+
+def device_stats(ids, params):
+    """
+    Build the summary statistics response shared by get_device_stats and get_devices_stats.
+    """
+    try:
+        start, end = parse_range(params)
+        payload = parse_payload_filter(params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    key = params.get('key')
+    mode = params.get('mode', 'exact')
+    if not key:
+        return Response({'error': 'Please provide the data key to summarize'}, status=status.HTTP_400_BAD_REQUEST)
+    if mode not in ['exact', 'approximate']:
+        return Response({'error': 'mode must be exact or approximate'}, status=status.HTTP_400_BAD_REQUEST)
+
+    compute = summary_stats if mode == 'exact' else approximate_summary_stats
+    return Response({'key': key, 'mode': mode, 'stats': compute(ids, key, start, end, payload)})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsLO])
+def get_device_stats(request, device_id):
+    """
+    Retrieve summary statistics of a data key of a device over a time range.
+
+    The count, min, max, mean, stddev and p50/p95/p99 of data[key] are
+    computed in the database with percentile_cont. With mode=approximate the
+    readings are streamed instead and the percentiles estimated with a
+    t-digest, which keeps memory bounded for very large windows.
+
+    Args:
+        request (HttpRequest): The HTTP request object with start, end, key and optionally mode, contains and has_key.
+        device_id (int): The ID of the device.
+
+    Returns:
+        Response: The statistics of the device, keyed by device id.
+    """
+    device = get_object_or_404(readable_devices(request.user, shard_for_device(device_id)), id=device_id)
+    return device_stats([device.id], request.query_params)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsLO])
+def get_devices_stats(request):
+    """
+    Retrieve summary statistics of a data key for several devices at once.
+
+    Takes the same parameters as get_device_stats plus ids, a comma separated
+    list of device ids. LO/LE users may only request their own devices.
+
+    Args:
+        request (HttpRequest): The HTTP request object with ids, start, end, key and optionally mode, contains and has_key.
+
+    Returns:
+        Response: The statistics of every requested device, keyed by device id.
+    """
+    try:
+        ids = parse_ids(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    missing = unreadable_devices(request.user, ids)
+    if missing:
+        return Response({'error': f'Devices not found: {", ".join(map(str, missing))}'},
+                        status=status.HTTP_404_NOT_FOUND)
+
+    return device_stats(ids, request.query_params)
+
+
+def in_boxes(boxes):
+    """
+    Build the filter matching devices inside any of the given bounding boxes.
+
+    The geohash prefixes of each box select candidates with index range scans,
+    the coordinate bounds then drop those outside the box but in a covering cell.
+    """
+    condition = Q()
+    for min_lat, min_lon, max_lat, max_lon in boxes:
+        prefixes = Q()
+        for prefix in cover(min_lat, min_lon, max_lat, max_lon):
+            prefixes |= Q(geohash__startswith=prefix)
+        condition |= prefixes & Q(latitude__range=(min_lat, max_lat), longitude__range=(min_lon, max_lon))
+    return condition
+
+
+def planar_distance(latitude, longitude, box):
+    """
+    Build an expression ordering devices by their approximate distance to a point.
+
+    Around the point the sphere is treated as a plane with longitudes scaled
+    by the cosine of its latitude. For the half of a box across the
+    antimeridian, the point is shifted by 360 degrees of longitude.
+    """
+    min_lon, max_lon = box[1], box[3]
+    longitude = min((longitude - 360, longitude, longitude + 360),
+                    key=lambda lon: max(min_lon - lon, 0, lon - max_lon))
+    scale = math.cos(math.radians(latitude)) ** 2
+    delta_lat = F('latitude') - latitude
+    delta_lon = F('longitude') - longitude
+    return ExpressionWrapper(delta_lat * delta_lat + delta_lon * delta_lon * scale, output_field=FloatField())
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsLO])
+def get_nearby_devices(request):
+    """
+    Find the devices located in a bounding box or within a radius of a point.
+
+    Pass min_lat, min_lon, max_lat and max_lon for a box, or lat, lon and
+    radius (in km) for a circle; circle results are sorted by distance and
+    carry distance_km. With latest=true every device also carries its latest
+    reading. LO/LE users only see their own devices.
+
+    Args:
+        request (HttpRequest): The HTTP request object with the area and optionally latest and limit.
+
+    Returns:
+        Response: The matching devices, at most limit of them.
+    """
+    try:
+        boxes, centre, radius = parse_area(request.query_params)
+        limit = parse_limit(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    rows = []
+    for shard in get_shards():
+        devices = readable_devices(request.user, shard)
+        if centre is None:
+            rows.extend(row_dicts(devices.filter(in_boxes(boxes)).order_by('id')[:limit], DEVICE_FIELDS))
+            continue
+        # Only the nearest candidates by planar distance leave the database, with a margin for its error
+        for box in boxes:
+            nearest = devices.filter(in_boxes([box])).order_by(planar_distance(*centre, box))
+            rows.extend(row_dicts(nearest[:limit * CANDIDATE_FACTOR], DEVICE_FIELDS))
+
+    if centre is not None:
+        for row in rows:
+            row['distance_km'] = distance_km(centre[0], centre[1], row['latitude'], row['longitude'])
+        # The boxes bound the circle, so corners still need dropping
+        rows = sorted((row for row in rows if row['distance_km'] <= radius), key=lambda row: row['distance_km'])
+    rows = rows[:limit]
+
+    if request.query_params.get('latest') in ['1', 'true']:
+        latest = latest_readings([row['id'] for row in rows])
+        for row in rows:
+            row['latest'] = latest.get(row['id'])
+    return Response(rows)
+
 
 """
 Lev Engineer
@@ -236,6 +553,7 @@ GET /users/{user_id}/details: View detailed user profiles
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated, IsLE])
+@throttle_classes([UserRateThrottle])
 def add_device(request):
     """
     Add a new device.
@@ -262,13 +580,18 @@ def add_device(request):
                 data['user'] = request.user.id
         else:
             data['user'] = request.user.id
-        serializer = DeviceSerializer(data=data)
 
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        shard = shard_for_user(data['user'])
+        with use_shard(shard):
+            serializer = DeviceSerializer(data=data)
+            if serializer.is_valid():
+                with transaction.atomic(using=shard):
+                    serializer.save()
+                    emit('device.created', serializer.data, shard)
+                bump_version('devices')
+                return Response(serializer.data, status=status.HTTP_201_CREATED)
+            else:
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     except KeyError:
         return Response({'error': 'Invalid input data'}, status=status.HTTP_400_BAD_REQUEST)
@@ -276,6 +599,7 @@ def add_device(request):
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated, IsLE])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
 def update_device(request, device_id):
     """
     Update a device with the provided device_id.
@@ -292,8 +616,8 @@ def update_device(request, device_id):
 
     """
     try:
-        device = get_object_or_404(Device, id=device_id)
-        if device.user != request.user or device.user.role not in ['LM', 'OW']:
+        device = get_object_or_404(Device.objects.using(shard_for_device(device_id)), id=device_id)
+        if device.user_id != request.user.pk or request.user.role not in ['LM', 'OW']:
             return Response({'error': 'You are not authorized to update this device'},
                             status=status.HTTP_401_UNAUTHORIZED)
 
@@ -303,7 +627,10 @@ def update_device(request, device_id):
 
         serializer = DeviceSerializer(device, data=data)
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic(using=device._state.db):
+                serializer.save()
+                emit('device.updated', serializer.data, device._state.db)
+            bump_version('devices')
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -331,6 +658,7 @@ PUT /users/{user_id}/permissions: Manage user roles and permissions
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated, IsLM])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
 def delete_device(request, device_id):
     """
     Delete a device.
@@ -342,13 +670,71 @@ def delete_device(request, device_id):
     Returns:
         Response: The HTTP response object with a success message.
     """
-    device = get_object_or_404(Device, id=device_id)
-    device.delete()
+    device = get_object_or_404(Device.objects.using(shard_for_device(device_id)), id=device_id)
+    revoke([(device.id, device.token_version)])
+    with transaction.atomic(using=device._state.db):
+        emit('device.deleted', {'id': device.id, 'user': device.user_id}, device._state.db)
+        device.delete()
+    bump_version('devices')
     return Response({'message': 'Device deleted successfully'}, status=status.HTTP_200_OK)
 
 
+def submittable_device(user, device_id):
+    """
+    Return a device from its shard primary if the user may submit its data, else raise Http404.
+
+    Device tokens submit data on behalf of the device, so only the users
+    submit_data accepts for the device may issue or revoke them.
+    """
+    device = get_object_or_404(Device.objects.using(shard_for_device(device_id)), id=device_id)
+    if not can_submit_data(user, device.user_id):
+        raise Http404
+    return device
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsLM])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
+def issue_device_token(request, device_id):
+    """
+    Issue a new token for a device, revoking its previous one.
+
+    The token authenticates the device itself on submit_data; it is shown
+    only in this response.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        device_id (int): The ID of the device.
+
+    Returns:
+        Response: The device ID and its new token.
+    """
+    device = submittable_device(request.user, device_id)
+    return Response({'device': device.id, 'token': rotate(device)}, status=status.HTTP_201_CREATED)
+
+
+@api_view(['DELETE'])
+@permission_classes([IsAuthenticated, IsLM])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
+def revoke_device_token(request, device_id):
+    """
+    Revoke the current token of a device without issuing another.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        device_id (int): The ID of the device.
+
+    Returns:
+        Response: The HTTP response object with a success message.
+    """
+    device = submittable_device(request.user, device_id)
+    rotate(device)
+    return Response({'message': 'Device token revoked'}, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsLM])
+@cache_response('devices')
 def get_all_devices(request):
     """
     Retrieve all devices.
@@ -356,16 +742,37 @@ def get_all_devices(request):
     This API endpoint allows authenticated users with LM (License Manager) permission
     to retrieve a list of all devices in the system.
 
+    Rows are encoded straight from values_list() to JSON, with the same
+    fields as DeviceSerializer. Devices are gathered from every shard in id
+    order; pass limit, and the last id received as after, to page through them.
+
     Returns:
         Response: A response object containing serialized data of all devices.
     """
-    devices = Device.objects.all()
-    serializer = DeviceSerializer(devices, many=True)
-    return Response(serializer.data)
+    try:
+        after = int(request.query_params.get('after', 0))
+        limit = int(request.query_params['limit']) if 'limit' in request.query_params else None
+    except ValueError:
+        return Response({'error': 'after and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if after < 0 or (limit is not None and limit < 1):
+        return Response({'error': 'after must not be negative and limit must be positive'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    rows = []
+    # Shards hold consecutive id blocks, so concatenating them keeps id order
+    for shard in get_shards():
+        devices = Device.objects.using(replica_for(shard)).filter(id__gt=after).order_by('id')
+        if limit is not None:
+            if len(rows) >= limit:
+                break
+            devices = devices[:limit - len(rows)]
+        rows.extend(row_dicts(devices, DEVICE_FIELDS))
+    return JSONBytesResponse(dumps(rows))
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsLM])
+@cache_response('users')
 def get_user(request, user_id):
     """
     Retrieve a specific user by their ID.
@@ -401,6 +808,7 @@ PUT /users/{user_id}/roles: Manage user roles and permissions
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated, IsOW])
+@throttle_classes([UserRateThrottle, DeviceRateThrottle])
 def update_device(request, device_id):
     """
     Update a device with the provided data.
@@ -413,14 +821,17 @@ def update_device(request, device_id):
         Response: The HTTP response containing the updated device data or error message.
     """
     try:
-        device = get_object_or_404(Device, id=device_id)
+        device = get_object_or_404(Device.objects.using(shard_for_device(device_id)), id=device_id)
         data = request.data
         if 'name' not in data or 'location' not in data or 'user' not in data:
             return Response({'error': 'Please provide name, location and user'}, status=status.HTTP_400_BAD_REQUEST)
 
         serializer = DeviceSerializer(device, data=data)
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic(using=device._state.db):
+                serializer.save()
+                emit('device.updated', serializer.data, device._state.db)
+            bump_version('devices')
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -431,11 +842,14 @@ def update_device(request, device_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsOW])
+@cache_response('users')
 def get_all_users(request):
     """
     Retrieve all users.
 
-    This API endpoint returns a list of all users in the system.
+    This API endpoint returns a list of all users in the system. Rows are
+    encoded straight from values_list() to JSON, with the fields of
+    CustomUserSerializer except the password.
 
     Parameters:
         request (HttpRequest): The HTTP request object.
@@ -443,13 +857,12 @@ def get_all_users(request):
     Returns:
         Response: The HTTP response containing the serialized data of all users.
     """
-    users = CustomUser.objects.all()
-    serializer = CustomUserSerializer(users, many=True)
-    return Response(serializer.data)
+    return JSONBytesResponse(encode_rows(CustomUser.objects.all(), USER_FIELDS))
 
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated, IsOW])
+@throttle_classes([UserRateThrottle])
 def manage_user_roles(request, user_id):
     """
     Manage the roles of a user.
@@ -473,7 +886,11 @@ def manage_user_roles(request, user_id):
 
         serializer = CustomUserSerializer(user, data=data)
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic():
+                serializer.save()
+                # Never the password hash
+                emit('user.updated', {'id': user.id, 'username': user.username, 'email': user.email, 'role': user.role})
+            bump_version('users')
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -484,6 +901,7 @@ def manage_user_roles(request, user_id):
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated, IsOW])
+@throttle_classes([UserRateThrottle])
 def delete_user(request, user_id):
     """
     Delete a user with the given user_id.
@@ -496,5 +914,75 @@ def delete_user(request, user_id):
         Response: A response indicating the success of the operation.
     """
     user = get_object_or_404(CustomUser, id=user_id)
-    user.delete()
-    return Response({'message': 'User deleted successfully'}, status=status.HTTP_200_OK)
\ No newline at end of file
+    # Devices on other shards are out of reach of the cascade from the primary
+    for shard in get_shards():
+        devices = Device.objects.using(shard).filter(user_id=user.id)
+        revoke(list(devices.values_list('id', 'token_version')))
+        devices.delete()
+    with transaction.atomic():
+        emit('user.deleted', {'id': user.id, 'username': user.username})
+        user.delete()
+    bump_version('users', 'devices')
+    return Response({'message': 'User deleted successfully'}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsOW])
+def get_webhooks(request):
+    """
+    List the webhook subscriptions.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        Response: The subscriptions, with their delivery state.
+    """
+    subscriptions = WebhookSubscription.objects.order_by('id')
+    return Response([
+        dict(WebhookSubscriptionSerializer(subscription).data,
+             failures=subscription.failures, next_attempt_at=subscription.next_attempt_at)
+        for subscription in subscriptions
+    ])
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsOW])
+@throttle_classes([UserRateThrottle])
+def add_webhook(request):
+    """
+    Subscribe an endpoint to device and user events.
+
+    Events are posted in batches as {"events": [...]} by the dispatch_webhooks
+    worker, signed with an HMAC-SHA256 of the body in the X-Webhook-Signature
+    header. The subscription receives the events emitted after its creation.
+
+    Args:
+        request (HttpRequest): The HTTP request object with url and optionally events and max_concurrency.
+
+    Returns:
+        Response: The subscription, with the signing secret, shown only in this response.
+    """
+    serializer = WebhookSubscriptionSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    subscription = serializer.save(user=request.user, secret=secrets.token_hex(32), cursors=current_cursors())
+    return Response(dict(serializer.data, secret=subscription.secret), status=status.HTTP_201_CREATED)
+
+
+@api_view(['DELETE'])
+@permission_classes([IsAuthenticated, IsOW])
+@throttle_classes([UserRateThrottle])
+def delete_webhook(request, webhook_id):
+    """
+    Delete a webhook subscription.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        webhook_id (int): The ID of the subscription.
+
+    Returns:
+        Response: The HTTP response object with a success message.
+    """
+    get_object_or_404(WebhookSubscription, id=webhook_id).delete()
+    return Response({'message': 'Webhook deleted successfully'}, status=status.HTTP_200_OK)
@@ -0,0 +1,260 @@
+import hashlib
+import hmac
+import http.client
+import random
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .fastpath import dumps
+from .models import OutboxEvent, WebhookSubscription
+from .sharding import get_shards
+
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+
+# Oldest transaction id still running on PostgreSQL, see transaction_horizon()
+HORIZON_SQL = 'txid_snapshot_xmin(txid_current_snapshot())'
+
+
+def emit(event_type, payload, using=DEFAULT_DB_ALIAS):
+    """
+    Record an event in the outbox of a database.
+
+    Call it inside the transaction of the change on that same database, so
+    that the event is stored if and only if the change is; delivery is left
+    to the dispatcher.
+
+    Args:
+        event_type (str): One of WebhookSubscription.EVENT_TYPES.
+        payload (dict): The JSON payload of the event.
+        using (str): The database the change was written to.
+    """
+    OutboxEvent.objects.using(using).create(type=event_type, payload=payload, txid=writer_txid(using))
+
+
+def emit_many(event_type, payloads, using=DEFAULT_DB_ALIAS):
+    """
+    Record several events of the same type with one insert, see emit().
+    """
+    txid = writer_txid(using)
+    OutboxEvent.objects.using(using).bulk_create([OutboxEvent(type=event_type, payload=payload, txid=txid)
+                                                  for payload in payloads])
+
+
+def writer_txid(using):
+    """
+    Return the value of OutboxEvent.txid for an event written now.
+
+    Ids are taken at insert time, not at commit time, so a transaction can
+    commit an event below ids already delivered. On PostgreSQL events carry
+    the id of their transaction, and only those of transactions older than
+    every running one are delivered, see transaction_horizon(). SQLite
+    serializes writers, so ids already follow commit order there.
+    """
+    if connections[using].vendor == 'postgresql':
+        return RawSQL('txid_current()', [])
+    return 0
+
+
+def transaction_horizon(alias):
+    """
+    Return the id of the oldest transaction still running on a database, or None where ids follow commit order.
+
+    Every event with a lower txid is committed or rolled back for good.
+    """
+    if connections[alias].vendor != 'postgresql':
+        return None
+    with connections[alias].cursor() as cursor:
+        cursor.execute(f'SELECT {HORIZON_SQL}')
+        return cursor.fetchone()[0]
+
+
+def outbox_databases():
+    """
+    Return the databases holding an outbox: the primary and every shard.
+    """
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *get_shards()]))
+
+
+def final_events(alias, horizon):
+    """
+    Return the events of an outbox no running transaction can still add to, in delivery order.
+    """
+    events = OutboxEvent.objects.using(alias).order_by('txid', 'id')
+    if horizon is not None:
+        events = events.filter(txid__lt=horizon)
+    return events
+
+
+def after(events, cursor):
+    """
+    Filter events to those past a [txid, id] cursor.
+    """
+    txid, event_id = cursor
+    return events.filter(txid__gte=txid).exclude(txid=txid, id__lte=event_id)
+
+
+def current_cursors():
+    """
+    Return the position of the latest final event of every outbox, where a new subscription starts from.
+    """
+    cursors = {}
+    for alias in outbox_databases():
+        # The horizon is computed within the query, to spare a round trip
+        horizon = RawSQL(HORIZON_SQL, []) if connections[alias].vendor == 'postgresql' else None
+        last = final_events(alias, horizon).values_list('txid', 'id').last()
+        cursors[alias] = list(last) if last else [0, 0]
+    return cursors
+
+
+def sign(secret, body):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def event_json(alias, event):
+    return {'id': f'{alias}:{event.id}', 'type': event.type, 'created_at': event.created_at.isoformat(),
+            'data': event.payload}
+
+
+class Dispatcher:
+    """
+    Deliver outbox events to webhook subscriptions in batches.
+
+    Each subscription keeps, per database, the [txid, id] of the last event
+    it was sent. A round reads the final events past that cursor (see
+    writer_txid(); a long write transaction holds delivery back until it
+    ends), splits those of the subscribed types into batches of batch_size
+    and posts up to max_concurrency of them to the endpoint at once, over a
+    pool of max_workers threads shared by all endpoints. The cursor then
+    moves past the longest run of delivered batches. A failed batch is
+    retried with the batches after it once the exponential backoff of the
+    subscription has passed, so delivery is at least once and receivers
+    should deduplicate on the event id.
+    """
+
+    def __init__(self, batch_size=100, max_workers=8, timeout=10, backoff=1, max_backoff=300,
+                 opener=urllib.request.urlopen, clock=timezone.now, horizon=transaction_horizon):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.opener = opener
+        self.clock = clock
+        self.horizon = horizon
+
+    def due_subscriptions(self):
+        now = self.clock()
+        return [subscription for subscription in WebhookSubscription.objects.filter(is_active=True)
+                if subscription.next_attempt_at is None or subscription.next_attempt_at <= now]
+
+    def plan(self, subscription, horizons):
+        """
+        Pick the batches to send to a subscription in this round.
+
+        Args:
+            subscription (WebhookSubscription): The subscription.
+            horizons (dict): Per database, its transaction_horizon() for this round.
+
+        Returns:
+            list: (alias, events, cursor after the batch) tuples, in outbox order per database.
+        """
+        batches = []
+        budget = subscription.max_concurrency
+        for alias in outbox_databases():
+            if budget <= 0:
+                break
+            events = final_events(alias, horizons[alias])
+            scanned = list(after(events, subscription.cursors.get(alias, [0, 0]))[:self.batch_size * budget])
+            if not scanned:
+                continue
+            events = [event for event in scanned if not subscription.events or event.type in subscription.events]
+            if not events:
+                # Nothing subscribed in this range, skip it without a delivery
+                subscription.cursors[alias] = [scanned[-1].txid, scanned[-1].id]
+                continue
+            for start in range(0, len(events), self.batch_size):
+                batch = events[start:start + self.batch_size]
+                last = scanned[-1] if start + self.batch_size >= len(events) else batch[-1]
+                batches.append((alias, batch, [last.txid, last.id]))
+                budget -= 1
+        return batches
+
+    def deliver(self, subscription, alias, events):
+        body = dumps({'events': [event_json(alias, event) for event in events]})
+        request = urllib.request.Request(subscription.url, data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            SIGNATURE_HEADER: sign(subscription.secret, body),
+        })
+        try:
+            with self.opener(request, timeout=self.timeout) as response:
+                return 200 <= response.status < 300
+        # A malformed response (BadStatusLine, IncompleteRead, ...) fails the batch like a refused connection
+        except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError):
+            return False
+
+    def run_once(self):
+        """
+        Run one delivery round over every due subscription.
+
+        Returns:
+            int: The number of events delivered.
+        """
+        plans = []
+        horizons = {alias: self.horizon(alias) for alias in outbox_databases()}
+        for subscription in self.due_subscriptions():
+            cursors = dict(subscription.cursors)
+            plans.append((subscription, cursors, self.plan(subscription, horizons)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for subscription, cursors, batches in plans:
+                sent = [(alias, events, cursor, executor.submit(self.deliver, subscription, alias, events))
+                        for alias, events, cursor in batches]
+                futures.append((subscription, cursors, sent))
+
+        delivered = 0
+        for subscription, cursors, batches in futures:
+            if not batches and subscription.cursors == cursors:
+                # Idle subscription, nothing to record
+                continue
+            failed = set()
+            for alias, events, cursor, future in batches:
+                if alias in failed:
+                    continue
+                if future.result():
+                    subscription.cursors[alias] = cursor
+                    delivered += len(events)
+                else:
+                    failed.add(alias)
+
+            if failed:
+                subscription.failures += 1
+                delay = min(self.backoff * 2 ** (subscription.failures - 1), self.max_backoff)
+                subscription.next_attempt_at = self.clock() + timedelta(seconds=delay * random.uniform(0.5, 1))
+            else:
+                subscription.failures = 0
+                subscription.next_attempt_at = None
+            subscription.save(update_fields=['cursors', 'failures', 'next_attempt_at'])
+        return delivered
+
+    def prune(self):
+        """
+        Delete the outbox events every active subscription is past.
+
+        Returns:
+            int: The number of events deleted.
+        """
+        subscriptions = list(WebhookSubscription.objects.filter(is_active=True).values_list('cursors', flat=True))
+        deleted = 0
+        for alias in outbox_databases():
+            events = final_events(alias, self.horizon(alias))
+            if subscriptions:
+                txid, event_id = min(tuple(cursors.get(alias, [0, 0])) for cursors in subscriptions)
+                events = events.filter(txid__lte=txid).exclude(txid=txid, id__gt=event_id)
+            deleted += events.delete()[0]
+        return deleted
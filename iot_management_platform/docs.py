@@ -0,0 +1,60 @@
+import os
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import path, re_path
+from drf_yasg import openapi
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+# Only imported by urls.py when settings.API_DOCS is enabled, so that workers
+# serving the API alone never load drf_yasg.
+
+api_info = openapi.Info(
+    title="IOT Management API",
+    default_version='v1',
+)
+
+schema_view = get_schema_view(
+    api_info,
+    public=True,
+    permission_classes=[permissions.AllowAny],
+)
+
+CONTENT_TYPES = {
+    '.json': 'application/json',
+    '.yaml': 'application/yaml',
+}
+
+_schema_files = {}
+
+generated_schema_view = schema_view.without_ui(cache_timeout=settings.SWAGGER_CACHE_TIMEOUT)
+
+
+def schema_file_view(request, format):
+    """
+    Serve the schema written by `manage.py generate_swagger` to SWAGGER_SCHEMA_DIR.
+
+    Files are read once per process. Without a pre-generated file the schema
+    is generated on the first request and cached for SWAGGER_CACHE_TIMEOUT.
+    """
+    if format not in _schema_files:
+        schema_path = os.path.join(settings.SWAGGER_SCHEMA_DIR or '', f'swagger{format}')
+        if settings.SWAGGER_SCHEMA_DIR and os.path.exists(schema_path):
+            with open(schema_path, 'rb') as f:
+                _schema_files[format] = f.read()
+        else:
+            _schema_files[format] = None
+
+    content = _schema_files[format]
+    if content is None:
+        return generated_schema_view(request, format=format)
+    return HttpResponse(content, content_type=CONTENT_TYPES[format])
+
+
+urlpatterns = [
+    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_file_view, name='schema-json'),
+    path('swagger/', schema_view.with_ui('swagger', cache_timeout=settings.SWAGGER_CACHE_TIMEOUT),
+         name='schema-swagger-ui'),
+    path('redoc/', schema_view.with_ui('redoc', cache_timeout=settings.SWAGGER_CACHE_TIMEOUT), name='schema-redoc'),
+]
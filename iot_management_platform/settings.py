@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -29,10 +30,26 @@ INSTALLED_APPS = [
     'device_management',
     'rest_framework',
     'rest_framework.authtoken',
-    'drf_yasg',
-
 ]
 
+# Serve the API documentation (/swagger/, /redoc/). Set API_DOCS=0 in the
+# environment of workers that only serve the API to keep drf_yasg unloaded.
+API_DOCS = os.environ.get('API_DOCS', '1') == '1'
+
+if API_DOCS:
+    INSTALLED_APPS.append('drf_yasg')
+
+SWAGGER_SETTINGS = {
+    'DEFAULT_INFO': 'iot_management_platform.docs.api_info',
+}
+
+# Directory holding swagger.json/swagger.yaml written at build time with
+# `manage.py generate_swagger`; otherwise the schema is generated on the
+# first request and cached for SWAGGER_CACHE_TIMEOUT seconds.
+SWAGGER_SCHEMA_DIR = BASE_DIR / 'schema'
+
+SWAGGER_CACHE_TIMEOUT = 3600
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -56,16 +73,84 @@ SIMPLE_JWT = {
     'TOKEN_TYPE_CLAIM': 'token_type',
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Use a shared backend (memcached/redis) when running several workers so that
+# rate limit buckets are shared between them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cached GET responses, invalidated by version counters bumped on writes.
+RESPONSE_CACHE = 'default'
+
+RESPONSE_CACHE_TIMEOUT = 300
+
+# Token bucket rate limits for write endpoints, per role of the requesting user.
+# 'user' buckets are keyed by user, 'device' buckets by target device.
+RATE_LIMIT_CACHE = 'default'
+
+RATE_LIMITS = {
+    'user': {
+        'LO': '120/min',
+        'LE': '300/min',
+        'LM': '600/min',
+        'OW': '1200/min',
+    },
+    'device': {
+        'LO': '60/min',
+        'LE': '60/min',
+        'LM': '120/min',
+        'OW': '120/min',
+        # Devices submitting with their own token
+        'DV': '60/min',
+    },
+}
+
+# Device tokens are HMAC-signed with this secret; changing it invalidates all of them.
+DEVICE_TOKEN_SECRET = os.environ.get('DEVICE_TOKEN_SECRET', SECRET_KEY)
+
+# Seconds between reloads of the token revocations made by other processes
+DEVICE_TOKEN_REFRESH_INTERVAL = 30
+
+# Broker of the mqtt_ingest worker. Devices publish readings on MQTT_TOPIC,
+# whose first + level is the device id.
+MQTT_HOST = os.environ.get('MQTT_HOST', 'localhost')
+
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+
+MQTT_USERNAME = os.environ.get('MQTT_USERNAME')
+
+MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD')
+
+MQTT_TOPIC = 'devices/+/data'
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'device_management.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'device_management.middleware.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Profile this fraction of requests, plus those whose X-Profile header carries
+# PROFILING_TOKEN, into PROFILING_DIR. With neither set ProfilingMiddleware
+# unloads itself. Summarize the results with manage.py profile_report.
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+
+PROFILING_HEADER = 'X-Profile'
+
+PROFILING_DIR = BASE_DIR / 'profiles'
+
 ROOT_URLCONF = 'iot_management_platform.urls'
 
 TEMPLATES = [
@@ -102,6 +187,31 @@ DATABASES = {
 }
 
 
+# Devices and their data are sharded across the databases listed in SHARDS,
+# users and everything else stay on 'default'. Every shard needs its own
+# DATABASES entry, `migrate --database=<shard>` and then `configure_shards`.
+# The order of SHARDS must never change once devices have been created.
+
+SHARDS = ['default']
+
+DATABASE_ROUTERS = [
+    'device_management.replicas.ReplicaRouter',
+    'device_management.sharding.ShardRouter',
+]
+
+# Read replicas of each primary or shard, e.g. {'default': ['replica1']}. Reads
+# of GET requests go to a replica lagging at most REPLICA_MAX_LAG seconds,
+# except for users who wrote in the last READ_YOUR_WRITES_WINDOW seconds.
+# Responses stored in RESPONSE_CACHE are always read from the primaries.
+
+DATABASE_REPLICAS = {}
+
+REPLICA_MAX_LAG = 5
+
+REPLICA_CHECK_INTERVAL = 5
+
+READ_YOUR_WRITES_WINDOW = 10
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -1,19 +1,8 @@
-from django.urls import path, re_path
-from drf_yasg import openapi
-from drf_yasg.views import get_schema_view
-from rest_framework import permissions
+from django.conf import settings
+from django.urls import path
 
 from device_management import views
 
-schema_view = get_schema_view(
-    openapi.Info(
-        title="IOT Management API",
-        default_version='v1',
-    ),
-    public=True,
-    permission_classes=[permissions.AllowAny],
-)
-
 urlpatterns = [
     path('register/', views.register_user, name='register_user'),
     path('login/', views.login_user, name='login'),
@@ -23,11 +12,23 @@ urlpatterns = [
     path('users/<int:user_id>/delete/', views.delete_user, name='delete_user'),
     path('devices/', views.get_devices, name='get_devices'),
     path('devices/all/', views.get_all_devices, name='get_all_devices'),
+    path('devices/nearby/', views.get_nearby_devices, name='get_nearby_devices'),
     path('devices/add/', views.add_device, name='add_device'),
     path('devices/<int:device_id>/', views.update_device, name='update_device_info'),
     path('devices/<int:device_id>/delete/', views.delete_device, name='delete_device'),
+    path('devices/<int:device_id>/token/', views.issue_device_token, name='issue_device_token'),
+    path('devices/<int:device_id>/token/revoke/', views.revoke_device_token, name='revoke_device_token'),
     path('devices/add/data/', views.submit_data, name='submit_data'),
-    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('devices/data/', views.get_devices_data, name='get_devices_data'),
+    path('devices/<int:device_id>/data/', views.get_device_data, name='get_device_data'),
+    path('devices/stats/', views.get_devices_stats, name='get_devices_stats'),
+    path('devices/<int:device_id>/stats/', views.get_device_stats, name='get_device_stats'),
+    path('webhooks/', views.get_webhooks, name='get_webhooks'),
+    path('webhooks/add/', views.add_webhook, name='add_webhook'),
+    path('webhooks/<int:webhook_id>/delete/', views.delete_webhook, name='delete_webhook'),
 ]
+
+if settings.API_DOCS:
+    from .docs import urlpatterns as docs_urlpatterns
+
+    urlpatterns += docs_urlpatterns